@@ -26,11 +26,18 @@ if sys.hexversion < 0x02050000:
     sys.exit(1)
 IS_PY3 = sys.hexversion >= 0x03000000
 
+# Only modules needed to pass a diff through are imported here, cdiff runs on
+# every `git diff`, others are imported by the code paths using them to keep
+# startup fast.  See tests/startup.py
 import os
-import re
-import subprocess
-import errno
-import difflib
+import itertools
+import stat
+import time
+
+try:
+    from itertools import izip
+except ImportError:
+    izip = zip
 
 
 COLORS = {
@@ -59,6 +66,32 @@ REVISION_CONTROL = (
     (['hg', 'summary'], ['hg', 'diff'])
 )
 
+# Marker at workspace root for each revision control system, '.git' is a
+# file instead of a directory in git worktrees and submodules
+VCS_MARKERS = (
+    ('.git', 'git'),
+    ('.svn', 'svn'),
+    ('.hg', 'hg'),
+)
+
+# Default pager, args stolen fron git source:
+# github.com/git/git/blob/master/pager.c
+PAGER = 'less -FRSXK'
+
+# Rendered lines are joined into chunks of up to this many chars, each chunk
+# is encoded and written out in one call.  First chunks are smaller so first
+# screen shows up without delay
+OUTPUT_CHUNK_SIZE = 65536
+OUTPUT_FIRST_CHUNK_SIZE = 4096
+
+# Bytes moved per call when piped output is passed through untouched
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Input is parsed as bytes, lines are decoded only when rendered.  Lines not
+# valid in UTF-8 are decoded in the fallback encoding
+EMPTY = ''.encode()
+FALLBACK_ENCODING = 'latin-1'
+
 
 def ansi_code(color):
     return COLORS.get(color, '')
@@ -67,16 +100,664 @@ def colorize(text, start_color, end_color='reset'):
     return ansi_code(start_color) + text + ansi_code(end_color)
 
 
+# Splits a marked up line into text and ansi color code runs, the color codes
+# are at odd indexes.  Compiled on first use
+ANSI_CODE_PATTERN = r'(\x1b\[(?:1;)?\d{1,2}m)'
+_ANSI_CODE_REGEX = None
+
+# Cache of display width by character, filled in on first use
+_CHAR_WIDTH = {}
+
+# Fast check for the common all ASCII text, python >= 3.7
+_isascii = getattr(str, 'isascii', None)
+
+
+def char_width(char):
+    """Number of terminal columns char takes, 2 for East Asian wide chars"""
+    width = _CHAR_WIDTH.get(char)
+    if width is None:
+        import unicodedata
+        if unicodedata.combining(char):
+            width = 0
+        elif unicodedata.east_asian_width(char) in ('W', 'F'):
+            width = 2
+        else:
+            width = 1
+        _CHAR_WIDTH[char] = width
+    return width
+
+
+def display_width(text):
+    """Number of terminal columns text takes, text must not contain color
+    codes"""
+    if not text or (_isascii and _isascii(text)) or max(text) < u'\u0300':
+        return len(text)
+    width = 0
+    for char in text:
+        width += char_width(char)
+    return width
+
+
+def fit_width(markup, width, pad=False):
+    """Truncate or pad a line with ansi color codes to given display width in
+    one pass, a truncated line ends with a '>'.  Only left side need to set
+    `pad`
+    """
+    global _ANSI_CODE_REGEX
+    if _ANSI_CODE_REGEX is None:
+        import re
+        _ANSI_CODE_REGEX = re.compile(ANSI_CODE_PATTERN)
+
+    out = []
+    is_text = []
+    count = 0
+    truncated = False
+
+    parts = _ANSI_CODE_REGEX.split(markup)
+    for idx, part in enumerate(parts):
+        if idx % 2:
+            out.append(part)
+            is_text.append(False)
+            continue
+        if not part:
+            continue
+        part_width = display_width(part)
+        if count + part_width <= width:
+            out.append(part)
+            is_text.append(True)
+            count += part_width
+            continue
+
+        # Run crosses the boundary, take what fits char by char
+        for pos, char in enumerate(part):
+            char_w = char_width(char)
+            if count + char_w > width:
+                break
+            count += char_w
+        out.append(part[:pos])
+        is_text.append(True)
+        truncated = True
+        break
+
+    if truncated:
+        # Make room for the '>' marker in last column
+        while count > width - 1 and out:
+            piece = out.pop()
+            if not is_text.pop():
+                continue
+            while piece and count > width - 1:
+                count -= char_width(piece[-1])
+                piece = piece[:-1]
+            if piece:
+                out.append(piece)
+                is_text.append(True)
+        out.append(ansi_code('reset') + colorize('>', 'lightmagenta'))
+        count += 1
+
+    if count < width and pad:
+        out.append(' ' * (width - count))
+
+    return ''.join(out)
+
+
+# Color of each part of the output, values are keys of COLORS, several can be
+# given separated by space.  Intraline markers are drawn on top of the color of
+# a changed line.  Change it before rendering for another theme
+THEME = {
+    'header'        : 'cyan',
+    'old_path'      : 'yellow',
+    'new_path'      : 'yellow',
+    'hunk_header'   : 'lightblue',
+    'common'        : 'reset',
+    'old'           : 'lightred',       # deleted line
+    'new'           : 'lightgreen',     # added line
+    'old_changed'   : 'red',            # line of a changed pair
+    'new_changed'   : 'green',
+    'deleted'       : 'reverse',        # intraline markers
+    'inserted'      : 'reverse',
+    'replaced'      : 'underline',
+    'line_number'   : 'yellow',
+}
+
+class Renderer(object):
+    """Escape codes of a theme turned into templates once, so rendering a
+    line is one formatting step"""
+
+    def __init__(self, theme):
+        def code(part):
+            return ''.join([ansi_code(c) for c in theme[part].split()])
+
+        reset = ansi_code('reset')
+        for part in ('header', 'old_path', 'new_path', 'hunk_header',
+                     'common', 'old', 'new'):
+            setattr(self, part, code(part) + '%s' + reset)
+        self.common_line = code('common') + ' %s' + reset
+        self.old_sign = self.old % '-'
+        self.new_sign = self.new % '+'
+
+        old, new = code('old_changed'), code('new_changed')
+        self.old_changed = old + '%s' + reset
+        self.new_changed = new + '%s' + reset
+        # Old line has only deleted and replaced markers, new line has only
+        # inserted and replaced ones
+        self._old_marks = (code('deleted') + old, code('replaced') + old,
+                           reset + old)
+        self._new_marks = (code('inserted') + new, code('replaced') + new,
+                           reset + new)
+        self._number = code('line_number')
+        self._rows = {}
+
+    def old_mix(self, line):
+        deleted, replaced, end = self._old_marks
+        return self.old_changed % line.replace('\x00-', deleted).replace(
+                '\x00^', replaced).replace('\x01', end)
+
+    def new_mix(self, line):
+        inserted, replaced, end = self._new_marks
+        return self.new_changed % line.replace('\x00+', inserted).replace(
+                '\x00^', replaced).replace('\x01', end)
+
+    def row(self, num_width):
+        """Template of side by side row, takes tuple (left number, left,
+        right number, right)"""
+        fmt = self._rows.get(num_width)
+        if fmt is None:
+            reset = ansi_code('reset')
+            num = self._number + '%' + str(num_width) + 's' + reset
+            fmt = self._rows[num_width] = (num + ' %s ' + reset + num +
+                                           ' %s\n')
+        return fmt
+
+
+_RENDERER = None
+
+
+def get_renderer():
+    """Renderer of THEME, compiled on first use"""
+    global _RENDERER
+    if _RENDERER is None or _RENDERER[0] != THEME:
+        _RENDERER = (dict(THEME), Renderer(THEME))
+    return _RENDERER[1]
+
+
+def fit_markup(markup, text_width, width, pad=False):
+    """Same as fit_width() given display width of text in markup, which is
+    enough when it fits"""
+    if text_width > width:
+        return fit_width(markup, width, pad)
+    if pad and text_width < width:
+        return markup + ' ' * (width - text_width)
+    return markup
+
+
+def marked_width(line):
+    """Display width of line with intraline markers from mdiff(), None if it
+    holds escape codes and needs fit_width() to find out"""
+    if '\x1b' in line:
+        return None
+    width = display_width(line)
+    if '\x00' in line or '\x01' in line:
+        width -= line.count('\x00') * 2 + line.count('\x01')
+    return width
+
+
+# Similarity needed for two lines to be paired and highlighted char by char,
+# same as the cutoff difflib uses
+INTRALINE_CUTOFF = 0.75
+
+# Differing middle part of a line pair longer than this is highlighted as a
+# whole instead of fed to difflib.SequenceMatcher
+INTRALINE_MAX_CHARS = 400
+
+# How many lines to look ahead for a similar line when pairing changed lines
+INTRALINE_SYNC_WINDOW = 4
+
+# Hunks beyond line length or work limit are shown with plain -/+ coloring,
+# no intraline highlight, so one pathological hunk can't block the view.
+# Line length and work are counted in bytes for memory-mapped patch files.
+# Hunks with more lines are diffed in windows of about that many lines, the
+# other limits apply to each window.
+MAX_HUNK_LINES = 20000          # lines in hunk, or in a window
+MAX_LINE_LENGTH = 5000          # length of the longest line
+MAX_INTRALINE_WORK = 2000000    # total length of changed lines
+
+# Appended to header of a hunk shown without intraline highlight
+SIMPLIFIED_MARK = ' (simplified, hunk too large for intraline diff)'
+
+# Max total chars of line pairs and results kept in the intraline cache
+INTRALINE_CACHE_SIZE = 8 * 1024 * 1024
+
+
+class LRUCache(object):
+    """Least recently used cache bounded by total size of entries, size of
+    each entry is given by caller"""
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        # Empty until first put() so the module loads without collections
+        self._data = {}
+        self._ordered = False
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _order(self):
+        self._ordered = True
+        try:
+            from collections import OrderedDict
+            self._data = OrderedDict(self._data)
+        except ImportError:
+            # Python < 2.7, caching disabled
+            self._max_size = 0
+
+    def get(self, key, default=None):
+        try:
+            entry = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size):
+        if not self._ordered:
+            self._order()
+        if size > self._max_size:
+            return
+        if key in self._data:
+            self._size -= self._data.pop(key)[1]
+        self._data[key] = (value, size)
+        self._size += size
+        while self._size > self._max_size:
+            self._size -= self._data.popitem(last=False)[1][1]
+
+    def clear(self):
+        self._data.clear()
+        self._size = 0
+
+
+def difflib_mdiff(old, new):
+    """Intraline diff engine backed by difflib._mdiff(), accurate but goes
+    quadratic on large hunks with long lines"""
+    import difflib
+    return difflib._mdiff(old, new)
+
+
+def _prefix_len(a, b):
+    """Length of common prefix, binary search on slices to stay in C"""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _suffix_len(a, b, limit):
+    """Length of common suffix, no longer than limit"""
+    la, lb = len(a), len(b)
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[la - mid:] == b[lb - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+# Results of _intraline() shared by all diffs, mass refactors repeat the same
+# line pairs many times
+INTRALINE_CACHE = LRUCache(INTRALINE_CACHE_SIZE)
+_MISSING = object()
+
+
+def _intraline(a, b):
+    """Returns tuple (ratio, marked a, marked b) with difflib._mdiff() style
+    markers if the two lines are similar enough, otherwise None"""
+    if a == b:
+        return (1.0, a, b)
+    la, lb = len(a), len(b)
+    if 2.0 * min(la, lb) / (la + lb) <= INTRALINE_CUTOFF:
+        return None
+
+    key = (a, b)
+    result = INTRALINE_CACHE.get(key, _MISSING)
+    if result is _MISSING:
+        result = _match_pair(a, b)
+        size = la + lb
+        if result:
+            size += len(result[1]) + len(result[2])
+        INTRALINE_CACHE.put(key, result, size)
+    return result
+
+
+def _match_pair(a, b):
+    la, lb = len(a), len(b)
+    p = _prefix_len(a, b)
+    s = _suffix_len(a, b, min(la, lb) - p)
+    ma = a[p:la - s]
+    mb = b[p:lb - s]
+
+    matched = p + s
+    if ma and mb and len(ma) + len(mb) <= INTRALINE_MAX_CHARS:
+        import difflib
+        opcodes = difflib.SequenceMatcher(None, ma, mb).get_opcodes()
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == 'equal':
+                matched += i2 - i1
+    elif ma and mb:
+        opcodes = [('replace', 0, len(ma), 0, len(mb))]
+    elif ma:
+        opcodes = [('delete', 0, len(ma), 0, 0)]
+    else:
+        opcodes = [('insert', 0, 0, 0, len(mb))]
+
+    ratio = 2.0 * matched / (la + lb)
+    if ratio <= INTRALINE_CUTOFF:
+        return None
+
+    out_a = [a[:p]]
+    out_b = [b[:p]]
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            out_a.append(ma[i1:i2])
+            out_b.append(mb[j1:j2])
+        elif tag == 'replace':
+            out_a.append('\x00^' + ma[i1:i2] + '\x01')
+            out_b.append('\x00^' + mb[j1:j2] + '\x01')
+        elif tag == 'delete':
+            out_a.append('\x00-' + ma[i1:i2] + '\x01')
+        else:
+            out_b.append('\x00+' + mb[j1:j2] + '\x01')
+    out_a.append(a[la - s:])
+    out_b.append(b[lb - s:])
+    return (ratio, ''.join(out_a), ''.join(out_b))
+
+
+def _unique_lines(lines, lo, hi):
+    """Returns dict of line -> index for lines occur once in lines[lo:hi]"""
+    seen = {}
+    for i in range(lo, hi):
+        line = lines[i]
+        if line in seen:
+            seen[line] = None
+        else:
+            seen[line] = i
+    for line in [k for k, v in seen.items() if v is None]:
+        del seen[line]
+    return seen
+
+
+def _patience_matches(a, b):
+    """Patience diff on lines, returns sorted list of (i, j) for a[i] == b[j]
+    considered common"""
+    import bisect
+    matches = []
+    ranges = [(0, len(a), 0, len(b))]
+    while ranges:
+        alo, ahi, blo, bhi = ranges.pop()
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matches.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+
+        uniq_a = _unique_lines(a, alo, ahi)
+        uniq_b = _unique_lines(b, blo, bhi)
+        anchors = [(i, uniq_b[line]) for line, i in uniq_a.items()
+                   if line in uniq_b]
+        if not anchors:
+            continue
+        anchors.sort()
+
+        # Longest increasing subsequence on b index by patience sorting
+        tails = []
+        tails_idx = []
+        prev = [None] * len(anchors)
+        for k, (i, j) in enumerate(anchors):
+            pos = bisect.bisect_left(tails, j)
+            if pos > 0:
+                prev[k] = tails_idx[pos - 1]
+            if pos == len(tails):
+                tails.append(j)
+                tails_idx.append(k)
+            else:
+                tails[pos] = j
+                tails_idx[pos] = k
+
+        k = tails_idx[-1]
+        while k is not None:
+            i, j = anchors[k]
+            matches.append((i, j))
+            ranges.append((i + 1, ahi, j + 1, bhi))
+            ahi, bhi = i, j
+            k = prev[k]
+        ranges.append((alo, ahi, blo, bhi))
+
+    matches.sort()
+    return matches
+
+
+def _pair_lines(old, new, i, i_end, j, j_end):
+    """Pair up changed lines old[i:i_end] and new[j:j_end], yields tuples in
+    the same form as difflib._mdiff()"""
+    while i < i_end and j < j_end:
+        if old[i] == new[j]:
+            yield (i + 1, old[i]), (j + 1, new[j]), False
+            i += 1
+            j += 1
+            continue
+
+        # Find the most similar pair within a small window, lines skipped
+        # over are yielded as deleted or added
+        best = _intraline(old[i], new[j])
+        skip_i = skip_j = 0
+        for d in range(1, INTRALINE_SYNC_WINDOW + 1):
+            if j + d < j_end:
+                pair = _intraline(old[i], new[j + d])
+                if pair and (not best or pair[0] > best[0]):
+                    best, skip_i, skip_j = pair, 0, d
+            if i + d < i_end:
+                pair = _intraline(old[i + d], new[j])
+                if pair and (not best or pair[0] > best[0]):
+                    best, skip_i, skip_j = pair, d, 0
+
+        if skip_i or skip_j:
+            for k in range(i, i + skip_i):
+                yield (k + 1, '\x00-' + old[k] + '\x01'), ('', '\n'), True
+            for k in range(j, j + skip_j):
+                yield ('', '\n'), (k + 1, '\x00+' + new[k] + '\x01'), True
+            i += skip_i
+            j += skip_j
+            continue
+
+        if best:
+            yield (i + 1, best[1]), (j + 1, best[2]), True
+        else:
+            yield (i + 1, '\x00-' + old[i] + '\x01'), \
+                    (j + 1, '\x00+' + new[j] + '\x01'), True
+        i += 1
+        j += 1
+
+    for k in range(i, i_end):
+        yield (k + 1, '\x00-' + old[k] + '\x01'), ('', '\n'), True
+    for k in range(j, j_end):
+        yield ('', '\n'), (k + 1, '\x00+' + new[k] + '\x01'), True
+
+
+def fast_mdiff(old, new):
+    """Default intraline diff engine, pairs lines with patience diff and
+    highlights a paired line with bounded character level matching"""
+    i = j = 0
+    for mi, mj in _patience_matches(old, new) + [(len(old), len(new))]:
+        for row in _pair_lines(old, new, i, mi, j, mj):
+            yield row
+        if mi < len(old):
+            yield (mi + 1, old[mi]), (mj + 1, new[mj]), False
+        i, j = mi + 1, mj + 1
+
+
+# Intraline diff engines, each takes a list of old lines and a list of new
+# lines and returns an iterator of (old, new, changed) tuples like
+# difflib._mdiff()
+DIFF_ENGINES = {
+    'fast': fast_mdiff,
+    'difflib': difflib_mdiff,
+}
+DEFAULT_DIFF_ENGINE = 'fast'
+
+
+# Array typecode for offsets, must hold offsets of multi-GB patch files, 'q'
+# is available since python 3.3
+if sys.hexversion >= 0x03030000:
+    OFFSET_TYPECODE = 'q'
+else:
+    OFFSET_TYPECODE = 'l'
+
+
+class LineBuffer(object):
+    """Append-only byte buffer shared by all hunks of a file, hunk lines are
+    kept as offsets into it instead of one str object per line, and decoded
+    when sliced out"""
+
+    __slots__ = ('_text', '_pending', '_size')
+
+    def __init__(self):
+        self._text = EMPTY
+        self._pending = []
+        self._size = 0
+
+    def append(self, text):
+        """Returns tuple (start, end) of bytes text in buffer"""
+        self._pending.append(text)
+        start = self._size
+        self._size += len(text)
+        return (start, self._size)
+
+    def flush(self):
+        """Join pending text into the buffer"""
+        if self._pending:
+            self._text += EMPTY.join(self._pending)
+            self._pending = []
+
+    def slice(self, start, end):
+        if self._pending:
+            self.flush()
+        return decode(self._text[start:end])
+
+
+class PatchMap(object):
+    """Patch file mapped into memory.  Lines are found as the parser reads
+    on, and hunk lines are kept as byte ranges in the map and decoded only
+    when rendered, so cost depends on what is displayed, not the file size"""
+
+    def __init__(self, path):
+        self._path = path
+        self._file = open(path, 'rb')
+        try:
+            st = os.fstat(self._file.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                raise ValueError('not a regular file: %s' % path)
+            if st.st_size:
+                import mmap
+                self._map = mmap.mmap(self._file.fileno(), 0,
+                        access=mmap.ACCESS_READ)
+            else:
+                # Empty file can not be mapped
+                self._map = EMPTY
+        except:
+            self._file.close()
+            raise
+
+    def __len__(self):
+        return len(self._map)
+
+    def __iter__(self):
+        for line, start, end in self.spans():
+            yield line
+
+    def spans(self):
+        """Yields tuple (line, start, end) for each line, line is bytes and
+        keeps the line ending ('\r\n' for DOS format)"""
+        data = self._map
+        size = len(data)
+        newline = '\n'.encode()
+        pos = 0
+        while pos < size:
+            end = data.find(newline, pos) + 1 or size
+            yield data[pos:end], pos, end
+            pos = end
+
+    def new_buffer(self):
+        """Hunks of all files refer to the map itself"""
+        return self
+
+    def flush(self):
+        pass
+
+    def slice(self, start, end):
+        return decode(self._map[start:end])
+
+    def raw(self, start, end):
+        """Bytes at offsets, not decoded"""
+        return self._map[start:end]
+
+    def update_digest(self, digest):
+        """Feed whole file to a hashlib object"""
+        digest.update(self._map)
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._file.close()
+
+    def __reduce__(self):
+        # Hunks sent to pool workers refer to the file by path, each worker
+        # maps it once
+        return _worker_patch_map, (self._path,)
+
+
+# PatchMap by path in a pool worker
+_WORKER_PATCH_MAPS = {}
+
+
+def _worker_patch_map(path):
+    patch_map = _WORKER_PATCH_MAPS.get(path)
+    if patch_map is None:
+        patch_map = _WORKER_PATCH_MAPS[path] = PatchMap(path)
+    return patch_map
+
+
 class Hunk(object):
 
-    def __init__(self, hunk_header, old_addr, new_addr):
+    __slots__ = ('_hunk_header', '_old_addr', '_new_addr', '_buffer',
+                 '_offsets', '_attrs', '_simplified')
+
+    def __init__(self, hunk_header, old_addr, new_addr, buffer=None):
+        """buffer is a LineBuffer, or a PatchMap the hunk lines refer to"""
+        if buffer is None:
+            buffer = LineBuffer()
+        import array
         self._hunk_header = hunk_header
         self._old_addr = old_addr   # tuple (start, offset)
         self._new_addr = new_addr   # tuple (start, offset)
-        self._hunk_list = []        # list of tuple (attr, line)
+        self._buffer = buffer
+        # Start and end offset of each line in buffer
+        self._offsets = array.array(OFFSET_TYPECODE)
+        self._attrs = array.array('B')  # ord() of attr of each line
+        self._simplified = None
 
     def get_header(self):
-        return self._hunk_header
+        return decode(self._hunk_header)
 
     def get_old_addr(self):
         return self._old_addr
@@ -86,10 +767,18 @@ class Hunk(object):
 
     def append(self, attr, line):
         """attr: '-': old, '+': new, ' ': common"""
-        self._hunk_list.append((attr, line))
-
-    def mdiff(self):
-        r"""The difflib._mdiff() function returns an interator which returns a
+        start, end = self._buffer.append(line)
+        self.append_span(attr, start, end)
+
+    def append_span(self, attr, start, end):
+        """Append a line already in buffer at offset start to end"""
+        self._attrs.append(ord(attr))
+        self._offsets.append(start)
+        self._offsets.append(end)
+
+    def mdiff(self, diff_engine=DEFAULT_DIFF_ENGINE):
+        r"""Run the intraline diff engine (see DIFF_ENGINES) on this hunk, the
+        engine returns an interator like difflib._mdiff() which returns a
         tuple: (from line tuple, to line tuple, boolean flag)
 
         from/to line tuple -- (line num, line text)
@@ -103,29 +792,172 @@ class Hunk(object):
         boolean flag -- None indicates context separation, True indicates
             either "from" or "to" line contains a change, otherwise False.
         """
-        return difflib._mdiff(self._get_old_text(), self._get_new_text())
+        if self.is_simplified():
+            return self._plain_mdiff(self)
+        engine = DIFF_ENGINES[diff_engine]
+        if self.is_windowed():
+            if PROFILER:
+                return PROFILER.iterate('intraline', self._windowed_mdiff,
+                        engine, hunk=self.get_header())
+            return self._windowed_mdiff(engine)
+        if PROFILER:
+            return PROFILER.iterate('intraline', engine, self._get_old_text(),
+                    self._get_new_text(), hunk=self.get_header())
+        return engine(self._get_old_text(), self._get_new_text())
+
+    def is_windowed(self):
+        """True if hunk is beyond MAX_HUNK_LINES and is diffed in windows of
+        about that many lines, see _windowed_mdiff()"""
+        return len(self._attrs) > MAX_HUNK_LINES
+
+    def is_simplified(self):
+        """True if hunk is beyond MAX_LINE_LENGTH or MAX_INTRALINE_WORK and
+        is shown without intraline highlight, limits of a windowed hunk are
+        checked for each window instead"""
+        if self._simplified is None:
+            attrs = self._attrs
+            offsets = self._offsets
+            simplified = False
+            if not self.is_windowed():
+                common = ord(' ')
+                longest = 0
+                work = 0
+                for i, attr in enumerate(attrs):
+                    length = offsets[i * 2 + 1] - offsets[i * 2]
+                    if length > longest:
+                        longest = length
+                    if attr != common:
+                        work += length
+                simplified = (longest > MAX_LINE_LENGTH or
+                              work > MAX_INTRALINE_WORK)
+            self._simplified = simplified
+        return self._simplified
+
+    def _windowed_mdiff(self, engine):
+        """Same form as mdiff(), lines are fed to engine a window at a time
+        so memory is bounded by the window instead of the hunk.  A run of
+        changed lines longer than a window is cut into windows which pair
+        its n-th old and new lines, a window beyond MAX_LINE_LENGTH or
+        MAX_INTRALINE_WORK is shown without intraline highlight"""
+        attrs = self._attrs
+        size = len(attrs)
+        common = ord(' ')
+        # Old and new lines taken from a run of changed lines at a time
+        half = max(MAX_HUNK_LINES // 2, 1)
+        window = []     # tuple (attr, line) in hunk order
+        done = [0, 0]   # old and new lines before window
+        i = 0
+        while i < size:
+            if attrs[i] == common:
+                window.append((' ', self._line(i)))
+                i += 1
+            else:
+                end = i
+                while end < size and attrs[end] != common:
+                    end += 1
+                old = new = i
+                while old < end or new < end:
+                    old = self._take_lines(old, end, '-', half, window)
+                    new = self._take_lines(new, end, '+', half, window)
+                    if old < end or new < end:
+                        for row in self._mdiff_window(engine, window, done):
+                            yield row
+                        window = []
+                i = end
+            if len(window) >= MAX_HUNK_LINES:
+                for row in self._mdiff_window(engine, window, done):
+                    yield row
+                window = []
+        for row in self._mdiff_window(engine, window, done):
+            yield row
+
+    def _take_lines(self, i, end, attr, count, out):
+        """Append up to count lines of attr from lines i to end to out,
+        returns index to continue from, end if none is left"""
+        attrs = self._attrs
+        code = ord(attr)
+        while i < end and count:
+            if attrs[i] == code:
+                out.append((attr, self._line(i)))
+                count -= 1
+            i += 1
+        while i < end and attrs[i] != code:
+            i += 1
+        return i
+
+    def _mdiff_window(self, engine, window, done):
+        """Rows of one window numbered from start of hunk, done is updated
+        to count lines of the window"""
+        old = [line for attr, line in window if attr != '+']
+        new = [line for attr, line in window if attr != '-']
+        longest = work = 0
+        for attr, line in window:
+            longest = max(longest, len(line))
+            if attr != ' ':
+                work += len(line)
+        if longest > MAX_LINE_LENGTH or work > MAX_INTRALINE_WORK:
+            rows = self._plain_mdiff(window)
+        else:
+            rows = engine(old, new)
+        old_done, new_done = done
+        for old_line, new_line, changed in rows:
+            if old_line[0]:
+                old_line = (old_done + int(old_line[0]), old_line[1])
+            if new_line[0]:
+                new_line = (new_done + int(new_line[0]), new_line[1])
+            yield old_line, new_line, changed
+        done[0] += len(old)
+        done[1] += len(new)
+
+    def _plain_mdiff(self, lines):
+        """Same form as mdiff() but no lines are paired, each changed line
+        is marked as a whole.  lines are tuples (attr, line) like the hunk
+        iterates"""
+        old_num = new_num = 0
+        for attr, line in lines:
+            if attr == ' ':
+                old_num += 1
+                new_num += 1
+                yield (old_num, line), (new_num, line), False
+            elif attr == '-':
+                old_num += 1
+                yield (old_num, '\x00-' + line + '\x01'), ('', '\n'), True
+            else:
+                new_num += 1
+                yield ('', '\n'), (new_num, '\x00+' + line + '\x01'), True
 
     def _get_old_text(self):
-        out = []
-        for (attr, line) in self._hunk_list:
-            if attr != '+':
-                out.append(line)
-        return out
+        return self._get_text(ord('+'))
 
     def _get_new_text(self):
-        out = []
-        for (attr, line) in self._hunk_list:
-            if attr != '-':
-                out.append(line)
-        return out
+        return self._get_text(ord('-'))
+
+    def _get_text(self, skip_attr):
+        """Lines decoded into a list, kept only while the hunk is rendered
+        since engines index the same lines many times"""
+        buffer = self._buffer
+        offsets = self._offsets
+        return [buffer.slice(offsets[i * 2], offsets[i * 2 + 1])
+                for i, attr in enumerate(self._attrs) if attr != skip_attr]
+
+    def _line(self, i):
+        return self._buffer.slice(self._offsets[i * 2],
+                                  self._offsets[i * 2 + 1])
 
     def __iter__(self):
-        for hunk_line in self._hunk_list:
-            yield hunk_line
+        offsets = self._offsets
+        for i, attr in enumerate(self._attrs):
+            yield (chr(attr),
+                   self._buffer.slice(offsets[i * 2], offsets[i * 2 + 1]))
+
+    def __len__(self):
+        return len(self._attrs)
 
 
 class Diff(object):
 
+    __slots__ = ('_headers', '_old_path', '_new_path', '_hunks')
+
     def __init__(self, headers, old_path, new_path, hunks):
         self._headers = headers
         self._old_path = old_path
@@ -135,6 +967,19 @@ class Diff(object):
     # Follow detector and the parse_hunk_header() are suppose to be overwritten
     # by derived class
     #
+    def get_path(self):
+        """Returns path of the new file, or the old one if file is deleted"""
+        if self._new_path is None:
+            return ''
+        path = path_of(self._new_path)
+        if path == '/dev/null':
+            path = path_of(self._old_path)
+        return path
+
+    def line_count(self):
+        """Returns number of lines in all hunks"""
+        return sum([len(hunk) for hunk in self._hunks])
+
     def is_old_path(self, line):
         return False
 
@@ -164,74 +1009,43 @@ class Diff(object):
     def is_header(self, line):
         return False
 
-    def markup_traditional(self):
+    def markup_traditional(self, diff_engine=DEFAULT_DIFF_ENGINE):
         """Returns a generator"""
         for line in self._headers:
-            yield self._markup_header(line)
+            yield self._markup_header(decode(line))
+        if self._old_path is None:
+            # Only a note, e.g. a file only in one of two directories
+            return
 
-        yield self._markup_old_path(self._old_path)
-        yield self._markup_new_path(self._new_path)
+        yield self._markup_old_path(decode(self._old_path))
+        yield self._markup_new_path(decode(self._new_path))
 
+        r = get_renderer()
         for hunk in self._hunks:
-            yield self._markup_hunk_header(hunk.get_header())
-            for old, new, changed in hunk.mdiff():
+            yield self._markup_hunk_header(self._hunk_header(hunk))
+            for old, new, changed in hunk.mdiff(diff_engine):
                 if changed:
                     if not old[0]:
                         # The '+' char after \x00 is kept
                         # DEBUG: yield 'NEW: %s %s\n' % (old, new)
-                        line = new[1].strip('\x00\x01')
-                        yield self._markup_new(line)
+                        yield r.new % new[1].strip('\x00\x01')
                     elif not new[0]:
                         # The '-' char after \x00 is kept
                         # DEBUG: yield 'OLD: %s %s\n' % (old, new)
-                        line = old[1].strip('\x00\x01')
-                        yield self._markup_old(line)
+                        yield r.old % old[1].strip('\x00\x01')
                     else:
                         # DEBUG: yield 'CHG: %s %s\n' % (old, new)
-                        yield self._markup_old('-') + \
-                            self._markup_old_mix(old[1])
-                        yield self._markup_new('+') + \
-                            self._markup_new_mix(new[1])
+                        yield r.old_sign + r.old_mix(old[1])
+                        yield r.new_sign + r.new_mix(new[1])
                 else:
-                    yield self._markup_common(' ' + old[1])
+                    yield r.common_line % old[1]
 
-    def markup_side_by_side(self, width):
+    def markup_side_by_side(self, width, diff_engine=DEFAULT_DIFF_ENGINE):
         """Returns a generator"""
-        def _normalize(line):
-            return line.replace('\t', ' '*8).replace('\n', '').replace('\r', '')
-
-        def _fit_width(markup, width, pad=False):
-            """str len does not count correctly if left column contains ansi
-            color code.  Only left side need to set `pad`
-            """
-            out = []
-            count = 0
-            ansi_color_regex = r'\x1b\[(1;)?\d{1,2}m'
-            patt = re.compile('^(%s)(.*)' % ansi_color_regex)
-            repl = re.compile(ansi_color_regex)
-
-            while markup and count < width:
-                if patt.match(markup):
-                    out.append(patt.sub(r'\1', markup))
-                    markup = patt.sub(r'\3', markup)
-                else:
-                    # FIXME: utf-8 wchar might break the rule here, e.g.
-                    # u'\u554a' takes double width of a single letter, also this
-                    # depends on your terminal font.  I guess audience of this
-                    # tool never put that kind of symbol in their code :-)
-                    #
-                    out.append(markup[0])
-                    count += 1
-                    markup = markup[1:]
-
-            if count == width and repl.sub('', markup):
-                # stripped: output fulfil and still have ascii in markup
-                out[-1] = ansi_code('reset') + colorize('>', 'lightmagenta')
-            elif count < width and pad:
-                pad_len = width - count
-                out.append('%*s' % (pad_len, ''))
-
-            return ''.join(out)
+        if self._old_path is None:
+            for line in self._headers:
+                yield self._markup_header(decode(line))
+            return
 
         # Setup line width and number width
         if width <= 0:
@@ -241,302 +1055,2119 @@ class Diff(object):
         (start, offset) = self._hunks[-1].get_new_addr()
         max2 = start + offset - 1
         num_width = max(len(str(max1)), len(str(max2)))
-        left_num_fmt = colorize('%%(left_num)%ds' % num_width, 'yellow')
-        right_num_fmt = colorize('%%(right_num)%ds' % num_width, 'yellow')
-        line_fmt = left_num_fmt + ' %(left)s ' + ansi_code('reset') + \
-                right_num_fmt + ' %(right)s\n'
+        r = get_renderer()
+        row = r.row(num_width)
+        blank = ' ' * width
+        tab = ' ' * 8
 
         # yield header, old path and new path
         for line in self._headers:
-            yield self._markup_header(line)
-        yield self._markup_old_path(self._old_path)
-        yield self._markup_new_path(self._new_path)
+            yield self._markup_header(decode(line))
+        yield self._markup_old_path(decode(self._old_path))
+        yield self._markup_new_path(decode(self._new_path))
 
         # yield hunks
         for hunk in self._hunks:
-            yield self._markup_hunk_header(hunk.get_header())
-            for old, new, changed in hunk.mdiff():
+            yield self._markup_hunk_header(self._hunk_header(hunk))
+            # Overlong lines are cut before markup, enough to fill the column
+            # and trigger the '>' marker
+            if hunk.is_simplified():
+                max_len = width * 2 + 8
+            else:
+                max_len = None
+            old_start = hunk.get_old_addr()[0] - 1
+            new_start = hunk.get_new_addr()[0] - 1
+            for old, new, changed in hunk.mdiff(diff_engine):
                 if old[0]:
-                    left_num = str(hunk.get_old_addr()[0] + int(old[0]) - 1)
+                    left_num = str(old_start + int(old[0]))
                 else:
                     left_num = ' '
 
                 if new[0]:
-                    right_num = str(hunk.get_new_addr()[0] + int(new[0]) - 1)
+                    right_num = str(new_start + int(new[0]))
                 else:
                     right_num = ' '
 
-                left = _normalize(old[1])
-                right = _normalize(new[1])
+                left = old[1][:max_len].replace('\t', tab).replace(
+                        '\n', '').replace('\r', '')
+                right = new[1][:max_len].replace('\t', tab).replace(
+                        '\n', '').replace('\r', '')
 
                 if changed:
                     if not old[0]:
-                        left = '%*s' % (width, ' ')
+                        left = blank
                         right = right.lstrip('\x00+').rstrip('\x01')
-                        right = _fit_width(self._markup_new(right), width)
+                        right = fit_markup(r.new % right,
+                                           marked_width(right), width)
                     elif not new[0]:
                         left = left.lstrip('\x00-').rstrip('\x01')
-                        left = _fit_width(self._markup_old(left), width)
+                        left = fit_markup(r.old % left, marked_width(left),
+                                          width)
                         right = ''
                     else:
-                        left = _fit_width(self._markup_old_mix(left), width, 1)
-                        right = _fit_width(self._markup_new_mix(right), width)
+                        left = fit_markup(r.old_mix(left),
+                                          marked_width(left), width, True)
+                        right = fit_markup(r.new_mix(right),
+                                           marked_width(right), width)
                 else:
-                    left = _fit_width(self._markup_common(left), width, 1)
-                    right = _fit_width(self._markup_common(right), width)
-                yield line_fmt % {
-                    'left_num': left_num,
-                    'left': left,
-                    'right_num': right_num,
-                    'right': right
-                }
+                    left = fit_markup(r.common % left, marked_width(left),
+                                      width, True)
+                    right = fit_markup(r.common % right,
+                                       marked_width(right), width)
+                yield row % (left_num, left, right_num, right)
+
+    def _hunk_header(self, hunk):
+        header = hunk.get_header()
+        if hunk.is_simplified():
+            text = header.rstrip('\r\n')
+            header = text + SIMPLIFIED_MARK + header[len(text):]
+        return header
 
     def _markup_header(self, line):
-        return colorize(line, 'cyan')
+        return get_renderer().header % line
 
     def _markup_old_path(self, line):
-        return colorize(line, 'yellow')
+        return get_renderer().old_path % line
 
     def _markup_new_path(self, line):
-        return colorize(line, 'yellow')
+        return get_renderer().new_path % line
 
     def _markup_hunk_header(self, line):
-        return colorize(line, 'lightblue')
+        return get_renderer().hunk_header % line
 
     def _markup_common(self, line):
-        return colorize(line, 'reset')
+        return get_renderer().common % line
 
     def _markup_old(self, line):
-        return colorize(line, 'lightred')
+        return get_renderer().old % line
 
     def _markup_new(self, line):
-        return colorize(line, 'lightgreen')
-
-    def _markup_mix(self, line, base_color):
-        del_code = ansi_code('reverse') + ansi_code(base_color)
-        add_code = ansi_code('reverse') + ansi_code(base_color)
-        chg_code = ansi_code('underline') + ansi_code(base_color)
-        rst_code = ansi_code('reset') + ansi_code(base_color)
-        line = line.replace('\x00-', del_code)
-        line = line.replace('\x00+', add_code)
-        line = line.replace('\x00^', chg_code)
-        line = line.replace('\x01', rst_code)
-        return colorize(line, base_color)
+        return get_renderer().new % line
 
     def _markup_old_mix(self, line):
-        return self._markup_mix(line, 'red')
+        return get_renderer().old_mix(line)
 
     def _markup_new_mix(self, line):
-        return self._markup_mix(line, 'green')
+        return get_renderer().new_mix(line)
+
+
+# Prefixes the parser and --stat look for, lines are parsed as bytes
+OLD_PATH = '--- '.encode()
+NEW_PATH = '+++ '.encode()
+HUNK_HEADER = '@@ -'.encode()
+OLD = '-'.encode()
+NEW = '+'.encode()
+COMMON = ' '.encode()
+EOF_MARK = '\\'.encode()
+DIFF_COMMAND = 'diff '.encode()
+DIFF_GIT = 'diff --git '.encode()
+SVN_INDEX = 'Index: '.encode()
+BINARY_FILES = 'Binary files '.encode()
+NOT_HEADER = (EMPTY, OLD, NEW, COMMON, EOF_MARK, '@'.encode())
 
 
 class Udiff(Diff):
 
+    __slots__ = ()
+
     def is_old_path(self, line):
-        return line.startswith('--- ')
+        return line.startswith(OLD_PATH)
 
     def is_new_path(self, line):
-        return line.startswith('+++ ')
+        return line.startswith(NEW_PATH)
 
     def is_hunk_header(self, line):
-        return line.startswith('@@ -')
+        return line.startswith(HUNK_HEADER)
 
     def parse_hunk_header(self, hunk_header):
         # @@ -3,7 +3,6 @@
-        a = hunk_header.split()[1].split(',')   # -3 7
+        comma = ','.encode()
+        a = hunk_header.split()[1].split(comma)   # -3 7
         if len(a) > 1:
             old_addr = (int(a[0][1:]), int(a[1]))
         else:
-            # @@ -1 +1,2 @@
-            old_addr = (int(a[0][1:]), 0)
+            # @@ -1 +1,2 @@, count omitted is 1
+            old_addr = (int(a[0][1:]), 1)
 
-        b = hunk_header.split()[2].split(',')   # +3 6
+        b = hunk_header.split()[2].split(comma)   # +3 6
         if len(b) > 1:
             new_addr = (int(b[0][1:]), int(b[1]))
         else:
             # @@ -0,0 +1 @@
-            new_addr = (int(b[0][1:]), 0)
+            new_addr = (int(b[0][1:]), 1)
 
         return (old_addr, new_addr)
 
     def is_old(self, line):
-        return line.startswith('-') and not self.is_old_path(line)
+        return line.startswith(OLD) and not self.is_old_path(line)
 
     def is_new(self, line):
-        return line.startswith('+') and not self.is_new_path(line)
+        return line.startswith(NEW) and not self.is_new_path(line)
 
     def is_common(self, line):
-        return line.startswith(' ')
+        return line.startswith(COMMON)
 
     def is_eof(self, line):
         # \ No newline at end of file
-        return line.startswith('\\')
+        return line.startswith(EOF_MARK)
 
     def is_header(self, line):
-        return re.match(r'^[^+@\\ -]', line)
+        return line[:1] not in NOT_HEADER
+
+
+def path_of(path_line):
+    """Path in '--- path' or '+++ path' line, without timestamp"""
+    return decode(path_line[4:]).split('\t')[0].strip()
+
+
+def path_matcher(include=None, exclude=None):
+    """Returns function telling whether a file given old and new path is
+    wanted: either path matches a glob in include (if given), and neither
+    matches one in exclude.  Paths are also tried without the 'a/' or 'b/'
+    prefix of git"""
+    import fnmatch
+
+    def matches(paths, patterns):
+        for path in paths:
+            for pattern in patterns:
+                if fnmatch.fnmatch(path, pattern):
+                    return True
+        return False
+
+    def match(old_path, new_path):
+        paths = []
+        for path in (old_path, new_path):
+            if path != '/dev/null':
+                paths.append(path)
+                if path[:2] in ('a/', 'b/'):
+                    paths.append(path[2:])
+        if include and not matches(paths, include):
+            return False
+        return not (exclude and matches(paths, exclude))
+
+    return match
+
+
+# Lines between the 'diff ' or 'Index: ' line of a file and its '---' line,
+# or in place of '---' and '+++' for a binary file, rename or mode change
+FILE_HEADERS = tuple([prefix.encode() for prefix in (
+    'old mode ', 'new mode ', 'deleted file mode ', 'new file mode ',
+    'copy from ', 'copy to ', 'rename from ', 'rename to ',
+    'similarity index ', 'dissimilarity index ', 'index ', 'Binary files ',
+    'GIT binary patch', '=====', 'Cannot display: ', 'svn:mime-type = ')])
+RENAMED_FROM = ('rename from '.encode(), 'copy from '.encode())
+RENAMED_TO = ('rename to '.encode(), 'copy to '.encode())
+GIT_BINARY_PATCH = 'GIT binary patch'.encode()
+
+
+def _split_pair(text, sep):
+    """Old and new path in text joined by sep, e.g. 'a/x b/x' of a 'diff
+    --git' line.  Paths may contain sep, a split with the same path on both
+    sides but for the 'a/' and 'b/' prefix is preferred, then the first"""
+    splits = []
+    pos = text.find(sep)
+    while pos >= 0:
+        old, new = text[:pos], text[pos + len(sep):]
+        if old[2:] == new[2:] and old[:2] == 'a/' and new[:2] == 'b/':
+            return old, new
+        splits.append((old, new))
+        pos = text.find(sep, pos + 1)
+    return splits and splits[0] or (text, text)
+
+
+def diff_paths(line):
+    """Old and new path in a 'diff ', 'Index: ' or 'Binary files ... differ'
+    line, or None if it has none"""
+    text = decode(line).rstrip('\r\n')
+    if line.startswith(DIFF_GIT):
+        return _split_pair(text[len('diff --git '):], ' ')
+    if line.startswith(SVN_INDEX):
+        path = text[len('Index: '):]
+        return path, path
+    if line.startswith(BINARY_FILES):
+        if text.endswith(' differ'):
+            text = text[:-len(' differ')]
+        return _split_pair(text[len('Binary files '):], ' and ')
+    # 'diff -ru old new', paths with spaces are left to '---' and '+++'
+    words = text.split()
+    if len(words) < 3:
+        return None
+    return words[-2], words[-1]
+
+
+def _is_binary_patch_line(line):
+    # Base85 data with a length char first, blank line or 'literal N'
+    return ' '.encode() not in line.strip() or \
+        line.startswith(('literal '.encode(), 'delta '.encode()))
+
+
+def _release_held(held, paths, keep, match):
+    """Returns keep of a held file with no '---' and '+++' lines, decided by
+    its paths, and the held lines to yield.  Without paths it's not a file,
+    its lines are yielded"""
+    if not paths:
+        return keep, held
+    keep = match(*paths)
+    return keep, keep and held or []
+
+
+def filter_patch(stream, match):
+    """Yields items of stream, tuples (line, start, end) as DiffParser reads,
+    except for files rejected by match(old_path, new_path).  Headers of a
+    file are held from its 'diff ', 'Index: ' or '---' line until its paths
+    are known, from its '---' and '+++' lines, or for a file with none (e.g.
+    binary, renamed or mode changed) from its 'diff ', 'rename from/to' or
+    'Binary files' line.  Hunk bodies of rejected files are skipped by the
+    line counts in hunk headers, up to any line that ends a body.  Lines out
+    of files, such as commit and message of `git log -p`, are yielded"""
+    difflet = Udiff(None, None, None, None)
+    body_ends = BODY_ENDS + (SVN_INDEX,)
+    held = None         # headers of a file with paths not known yet
+    paths = None        # old and new path of the held file as far as known
+    binary_patch = False
+    keep = True
+    old_left = new_left = 0
+
+    for item in stream:
+        line = item[0]
+        if old_left > 0 or new_left > 0:
+            if not line.startswith(body_ends):
+                if keep:
+                    yield item
+                attr = line[:1]
+                if attr == COMMON:
+                    old_left -= 1
+                    new_left -= 1
+                elif attr == OLD:
+                    old_left -= 1
+                elif attr == NEW:
+                    new_left -= 1
+                continue
+            # Hunk shorter than its header says
+            old_left = new_left = 0
+
+        if held is not None:
+            if line.startswith(FILE_HEADERS) or \
+                    (binary_patch and _is_binary_patch_line(line)):
+                held.append(item)
+                if line.startswith(GIT_BINARY_PATCH):
+                    binary_patch = True
+                elif line.startswith(BINARY_FILES):
+                    paths = diff_paths(line)
+                elif line.startswith(RENAMED_FROM + RENAMED_TO):
+                    # 'rename from path', path is without 'a/' or 'b/'
+                    path = decode(line).rstrip('\r\n').split(' ', 2)[2]
+                    if line.startswith(RENAMED_FROM):
+                        paths = (path, paths and paths[1] or path)
+                    else:
+                        paths = (paths and paths[0] or path, path)
+                continue
+            last = held[-1][0]
+            if difflet.is_old_path(line) and not difflet.is_old_path(last):
+                held.append(item)
+                continue
+            binary_patch = False
+            if difflet.is_new_path(line) and difflet.is_old_path(last):
+                held.append(item)
+                keep = match(path_of(last), path_of(line))
+                if keep:
+                    for held_item in held:
+                        yield held_item
+                held = None
+                continue
+            keep, held = _release_held(held, paths, keep, match)
+            for held_item in held:
+                yield held_item
+            held = None
+
+        if line.startswith((DIFF_COMMAND, SVN_INDEX)) or \
+                difflet.is_old_path(line):
+            held = [item]
+            paths = not difflet.is_old_path(line) and diff_paths(line) or None
+            continue
+        if line.startswith(BINARY_FILES):
+            # Of `diff -r` on directories, with no 'diff ' line
+            keep = match(*diff_paths(line))
+        elif difflet.is_hunk_header(line):
+            old_addr, new_addr = difflet.parse_hunk_header(line)
+            old_left = old_addr[1]
+            new_left = new_addr[1]
+        elif difflet.is_header(line) or difflet.is_common(line):
+            # Commit and message of `git log -p`, common line before a file
+            # is taken as header by the parser too
+            yield item
+            continue
+        if keep:
+            # Or '\ No newline at end of file', and lines the parser rejects
+            yield item
+
+    # Not followed by hunks, left to the parser
+    if held is not None:
+        for held_item in _release_held(held, paths, keep, match)[1]:
+            yield held_item
 
 
 class DiffParser(object):
 
-    def __init__(self, stream):
-        """Detect Udiff with 3 conditions"""
+    def __init__(self, stream, include=None, exclude=None):
+        """Detect Udiff with 3 conditions, stream can be any iterable of lines
+        or a PatchMap and is consumed lazily, only first 20 lines are read
+        ahead.  Lines are parsed as bytes, text lines are encoded in UTF-8.
+        Only files with path matching a glob in include and none in exclude
+        are parsed, see path_matcher()"""
+        if isinstance(stream, PatchMap):
+            self._new_buffer = stream.new_buffer
+            stream = stream.spans()
+        else:
+            self._new_buffer = LineBuffer
+            stream = iter(stream)
+            head = list(itertools.islice(stream, 1))
+            if head and not isinstance(head[0], EMPTY.__class__):
+                stream = (line.encode('utf-8') for line in
+                          itertools.chain(head, stream))
+            else:
+                stream = itertools.chain(head, stream)
+            stream = izip(stream, itertools.repeat(None),
+                          itertools.repeat(None))
+        head = list(itertools.islice(stream, 20))
         flag = 0
-        for line in stream[:20]:
-            if line.startswith('--- '):
+        hunk_header = '@@ '.encode()
+        for line, _, _ in head:
+            if line.startswith(OLD_PATH):
                 flag |= 1
-            elif line.startswith('+++ '):
+            elif line.startswith(NEW_PATH):
                 flag |= 2
-            elif line.startswith('@@ '):
+            elif line.startswith(hunk_header):
                 flag |= 4
         if flag & 7:
             self._type = 'udiff'
         else:
             raise RuntimeError('unknown diff type')
 
+        self._stream = itertools.chain(head, stream)
+        if include or exclude:
+            self._stream = filter_patch(self._stream,
+                                        path_matcher(include, exclude))
+
+    def get_diffs(self):
+        """Returns a generator, each Diff object is yielded as soon as the
+        patch for that file ends"""
         try:
-            self._diffs = self._parse(stream)
+            for diff in self._parse(self._stream):
+                yield diff
         except (AssertionError, IndexError):
             raise RuntimeError('invalid patch format')
 
-    def get_diffs(self):
-        return self._diffs
-
     def _parse(self, stream):
-        """parse all diff lines, construct a list of Diff objects"""
+        """parse diff lines one by one, yield Diff objects"""
         if self._type == 'udiff':
             difflet = Udiff(None, None, None, None)
         else:
             raise RuntimeError('unsupported diff format')
 
-        out_diffs = []
         headers = []
         old_path = None
         new_path = None
         hunks = []
         hunk = None
+        buffer = self._new_buffer()
 
-        while stream:
+        for line, start, end in stream:
             # 'common' line occurs before 'old_path' is considered as header
             # too, this happens with `git log -p` and `git show <commit>`
             #
-            if difflet.is_header(stream[0]) or \
-                    (difflet.is_common(stream[0]) and old_path is None):
+            if difflet.is_header(line) or \
+                    (difflet.is_common(line) and old_path is None):
                 if headers and old_path:
                     # Encounter a new header
                     assert new_path is not None
                     assert hunk is not None
                     hunks.append(hunk)
-                    out_diffs.append(Diff(headers, old_path, new_path, hunks))
+                    buffer.flush()
+                    yield Diff(headers, old_path, new_path, hunks)
                     headers = []
                     old_path = None
                     new_path = None
                     hunks = []
                     hunk = None
-                else:
-                    headers.append(stream.pop(0))
+                    buffer = self._new_buffer()
+                headers.append(line)
 
-            elif difflet.is_old_path(stream[0]):
+            elif difflet.is_old_path(line):
                 if old_path:
                     # Encounter a new patch set
                     assert new_path is not None
                     assert hunk is not None
                     hunks.append(hunk)
-                    out_diffs.append(Diff(headers, old_path, new_path, hunks))
+                    buffer.flush()
+                    yield Diff(headers, old_path, new_path, hunks)
                     headers = []
                     old_path = None
                     new_path = None
                     hunks = []
                     hunk = None
-                else:
-                    old_path = stream.pop(0)
+                    buffer = self._new_buffer()
+                old_path = line
 
-            elif difflet.is_new_path(stream[0]):
+            elif difflet.is_new_path(line):
                 assert old_path is not None
                 assert new_path is None
-                new_path = stream.pop(0)
+                new_path = line
 
-            elif difflet.is_hunk_header(stream[0]):
+            elif difflet.is_hunk_header(line):
                 assert old_path is not None
                 assert new_path is not None
-                if hunk:
+                if hunk is not None:
                     # Encounter a new hunk header
                     hunks.append(hunk)
-                    hunk = None
-                else:
-                    hunk_header = stream.pop(0)
-                    old_addr, new_addr = difflet.parse_hunk_header(hunk_header)
-                    hunk = Hunk(hunk_header, old_addr, new_addr)
+                old_addr, new_addr = difflet.parse_hunk_header(line)
+                hunk = Hunk(line, old_addr, new_addr, buffer)
 
-            elif difflet.is_old(stream[0]) or difflet.is_new(stream[0]) or \
-                    difflet.is_common(stream[0]):
+            elif difflet.is_old(line) or difflet.is_new(line) or \
+                    difflet.is_common(line):
                 assert old_path is not None
                 assert new_path is not None
                 assert hunk is not None
-                hunk_line = stream.pop(0)
-                hunk.append(hunk_line[0], hunk_line[1:])
+                if start is None:
+                    hunk.append(line[:1], line[1:])
+                else:
+                    # Leading attr char is always 1 byte
+                    hunk.append_span(line[:1], start + 1, end)
 
-            elif difflet.is_eof(stream[0]):
+            elif difflet.is_eof(line):
                 # ignore
-                stream.pop(0)
+                pass
 
             else:
-                raise RuntimeError('unknown patch format: %s' % stream[0])
+                raise RuntimeError('unknown patch format: %s' % decode(line))
 
         # The last patch
-        if hunk:
+        if hunk is not None:
             hunks.append(hunk)
         if old_path:
             if new_path:
-                out_diffs.append(Diff(headers, old_path, new_path, hunks))
+                buffer.flush()
+                yield Diff(headers, old_path, new_path, hunks)
             else:
-                raise RuntimeError('unknown patch format after "%s"' % old_path)
+                raise RuntimeError('unknown patch format after "%s"' %
+                                   decode(old_path))
         elif headers:
-            raise RuntimeError('unknown patch format: %s' % \
-                    ('\n'.join(headers)))
+            # Trailing commit with no file, e.g. all files of it excluded
+            yield Diff(headers, None, None, [])
 
-        return out_diffs
 
+# Lines of context around changes when two files are compared, as `diff -u`
+DIFF_CONTEXT = 3
 
-class DiffMarkup(object):
+# Common lines needed after a change for the search of its edits to stop,
+# fewer between two changes and they are searched as one
+SYNC_LINES = 8
 
-    def __init__(self, stream):
-        self._diffs = DiffParser(stream).get_diffs()
+# Edits searched for one change before it's taken as replaced up to the next
+# SYNC_LINES common lines, Myers' algorithm goes quadratic in the number of
+# edits
+MAX_EDIT_COST = 500
 
-    def markup(self, side_by_side=False, width=0):
-        """Returns a generator"""
-        if side_by_side:
-            return self._markup_side_by_side(width)
+# A file with a NUL byte in its first this many bytes is binary, as in git
+BINARY_CHECK_SIZE = 8000
+
+# Bytes of a file split into lines at a time when two files are compared
+COMPARE_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class LoadedFile(PatchMap):
+    """File read into memory, for files that can't be mapped such as named
+    pipes from process substitution"""
+
+    def __init__(self, path):
+        self._path = path
+        f = open(path, 'rb')
+        try:
+            self._map = f.read()
+        finally:
+            f.close()
+
+    def close(self):
+        pass
+
+
+def _open_file(path):
+    try:
+        return PatchMap(path)
+    except ValueError:
+        return LoadedFile(path)
+
+
+def read_lines(patch_map):
+    """Returns list of lines in patch_map without newlines, split a chunk at
+    a time so it's done in C.  A last line without newline is wrapped in a
+    tuple so it doesn't equal the same line with one, as for `diff`"""
+    newline = '\n'.encode()
+    lines = []
+    size = len(patch_map)
+    pos = 0
+    while pos < size:
+        want = COMPARE_CHUNK_SIZE
+        while True:
+            chunk = patch_map.raw(pos, pos + want)
+            if pos + len(chunk) >= size:
+                break
+            end = chunk.rfind(newline) + 1
+            if end:
+                chunk = chunk[:end]
+                break
+            # Line longer than chunk
+            want *= 2
+        pos += len(chunk)
+        lines.extend(chunk.split(newline))
+        last = lines.pop()
+        if last:
+            lines.append((last,))
+    return lines
+
+
+def _common_run(a, b, x, y, limit):
+    """Length of common run of a[x:] and b[y:], up to limit.  Compared on
+    slices of growing size to stay in C"""
+    if not limit or a[x] != b[y]:
+        return 0
+    n = 1
+    size = 1
+    while n + size <= limit and a[x + n:x + n + size] == b[y + n:y + n + size]:
+        n += size
+        size *= 2
+    while size > 1:
+        size //= 2
+        if n + size <= limit and \
+                a[x + n:x + n + size] == b[y + n:y + n + size]:
+            n += size
+    return n
+
+
+def _myers_runs(a, b, alo, ahi, blo, bhi, max_cost, sync=0):
+    """Returns tuple (runs, i, j), runs is list of (i, j, n) for a[i:i + n]
+    == b[j:j + n] kept by a shortest edit script from a[alo:ahi] to
+    b[blo:bhi] found with Myers' O(ND) algorithm.  Search stops at (ahi,
+    bhi), or with sync given, at the first edit followed by sync or more
+    common lines, which end before a[i] and b[j].  None if more than
+    max_cost edits are needed"""
+    n = ahi - alo
+    m = bhi - blo
+    v = {1: 0}
+    trace = []
+    end = None
+    for d in range(min(n + m, max_cost) + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            common = 0
+            if x < n and y < m:
+                common = _common_run(a, b, alo + x, blo + y,
+                                     min(n - x, m - y))
+            if x + common >= n and y + common >= m:
+                end = (x + common, y + common)
+                break
+            if sync and common >= sync and end is None:
+                end = (x + common, y + common)
+            v[k] = x + common
+        else:
+            if end is None:
+                trace.append(v.copy())
+                continue
+        break
+    else:
+        return None
+
+    # Walk back through the saved frontiers, each step is an edit followed
+    # by a run of common lines
+    runs = []
+    x, y = end
+    for d in range(len(trace), 0, -1):
+        v = trace[d - 1]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prev_x = v[k + 1]
+            prev_y = prev_x - k - 1
+            mid_x = prev_x
+        else:
+            prev_x = v[k - 1]
+            prev_y = prev_x - k + 1
+            mid_x = prev_x + 1
+        if x > mid_x:
+            runs.append((alo + mid_x, blo + y - (x - mid_x), x - mid_x))
+        x, y = prev_x, prev_y
+    if x:
+        runs.append((alo, blo, x))
+    runs.reverse()
+    return (runs, alo + end[0], blo + end[1])
+
+
+def diff_lines(a, b, max_cost=MAX_EDIT_COST, sync=SYNC_LINES):
+    """Returns sorted list of (i, j, n) for runs a[i:i + n] == b[j:j + n]
+    kept unchanged.  Common runs are skipped by comparing slices, from each
+    line that differs a shortest edit script is searched with Myers'
+    algorithm till it is followed by sync common lines, so cost grows with
+    the number of changes rather than the file size.  A change needing more
+    than max_cost edits is taken as replaced up to the nearest following
+    sync common lines"""
+    runs = []
+    n = len(a)
+    m = len(b)
+    x = y = 0
+    positions = None
+    while x < n and y < m:
+        common = _common_run(a, b, x, y, min(n - x, m - y))
+        if common:
+            runs.append((x, y, common))
+            x += common
+            y += common
+            continue
+        found = _myers_runs(a, b, x, n, y, m, max_cost, sync)
+        if found is None:
+            if positions is None:
+                positions = _line_positions(b)
+            anchor = _next_anchor(a, b, x, y, positions, sync)
+            if anchor is None:
+                break
+            i, j = anchor
+            found = (_split_runs(a, b, x, i, y, j, max_cost), i, j)
+        part, x, y = found
+        runs.extend(part)
+    return runs
+
+
+def _split_runs(a, b, alo, ahi, blo, bhi, max_cost):
+    """Returns sorted list of common runs of a[alo:ahi] and b[blo:bhi] like
+    diff_lines().  Parts needing over max_cost edits are split at a line
+    occurring once in each near the middle, as histogram diff does, parts
+    with no such line are taken as replaced"""
+    runs = []
+    parts = [(alo, ahi, blo, bhi)]
+    while parts:
+        alo, ahi, blo, bhi = parts.pop()
+        anchor = None
+        if ahi - alo + bhi - blo > max_cost:
+            uniq_b = _unique_lines(b, blo, bhi)
+            mid = (alo + ahi) // 2
+            for line, i in _unique_lines(a, alo, ahi).items():
+                j = uniq_b.get(line)
+                if j is not None and (anchor is None or
+                                      abs(i - mid) < abs(anchor[0] - mid)):
+                    anchor = (i, j)
+        if anchor is not None:
+            i, j = anchor
+            runs.append((i, j, 1))
+            parts.append((alo, i, blo, j))
+            parts.append((i + 1, ahi, j + 1, bhi))
+            continue
+        found = _myers_runs(a, b, alo, ahi, blo, bhi, max_cost)
+        if found is not None:
+            runs.extend(found[0])
+    runs.sort()
+    return runs
+
+
+def _line_positions(lines):
+    """Returns dict of line -> list of its indexes in lines"""
+    positions = {}
+    for i, line in enumerate(lines):
+        indexes = positions.get(line)
+        if indexes is None:
+            positions[line] = [i]
         else:
-            return self._markup_traditional()
+            indexes.append(i)
+    return positions
+
+
+def _next_anchor(a, b, x, y, positions, sync):
+    """Returns (i, j) for i >= x and j >= y where sync common lines, or the
+    rest of both, start with the fewest lines of a and b skipped, None if
+    there is none.  positions is _line_positions(b)"""
+    import bisect
+    n = len(a)
+    m = len(b)
+    best = None
+    best_cost = n - x + m - y
+    i = x
+    while i < n and i - x < best_cost:
+        indexes = positions.get(a[i])
+        if indexes:
+            start = bisect.bisect_left(indexes, y)
+            for j in indexes[start:start + sync]:
+                cost = i - x + j - y
+                if cost >= best_cost:
+                    break
+                limit = min(n - i, m - j)
+                common = _common_run(a, b, i, j, min(limit, sync))
+                if common >= sync or (common == limit and
+                                      n - i == m - j):
+                    best, best_cost = (i, j), cost
+                    break
+        i += 1
+    return best
+
+
+def group_changes(runs, a_len, b_len, context=DIFF_CONTEXT):
+    """Group changes between unchanged runs into hunks like `diff -u`,
+    changes with up to 2 * context unchanged lines between are in the same
+    hunk.  Returns list of hunks, each a list of changes (i1, i2, j1, j2)
+    meaning a[i1:i2] is replaced by b[j1:j2]"""
+    changes = []
+    i = j = 0
+    for ri, rj, n in runs + [(a_len, b_len, 0)]:
+        if ri > i or rj > j:
+            changes.append((i, ri, j, rj))
+        i, j = ri + n, rj + n
+
+    groups = []
+    for change in changes:
+        if groups and change[0] - groups[-1][-1][1] <= context * 2:
+            groups[-1].append(change)
+        else:
+            groups.append([change])
+    return groups
+
+
+def encode_path_line(line):
+    """Encode line with file paths in it, bytes of paths not valid in the
+    file system encoding are kept as they are"""
+    if IS_PY3:
+        return line.encode('utf-8', 'surrogateescape')
+    return line
+
+
+def _format_range(start, end):
+    """Range a[start:end] as in a hunk header, count is left out if it is 1
+    and start is the line before if it is 0, as `diff -u` does"""
+    length = end - start
+    if length == 1:
+        return '%d' % (start + 1)
+    if not length:
+        return '%d,0' % start
+    return '%d,%d' % (start + 1, length)
+
+
+class FilePair(object):
+    """Two files compared in process instead of running `diff -u`, hunks are
+    made directly without a patch being written and parsed.  Iterating
+    yields the lines of the patch `diff -u` would give"""
+
+    def __init__(self, old_path, new_path, context=DIFF_CONTEXT,
+                 headers=None):
+        """headers are lines put before the patch, bytes"""
+        self._paths = (old_path, new_path)
+        self._context = context
+        self._headers = headers or []
+        self._old = _open_file(old_path)
+        try:
+            self._new = _open_file(new_path)
+        except:
+            self._old.close()
+            raise
+        self._groups = None
+
+    def _path_line(self, prefix, path):
+        """'--- path\\tmtime' line, with time in the format of `diff -u`"""
+        st = os.stat(path)
+        ns = getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9)) % 1000000000
+        mtime = time.localtime(st.st_mtime)
+        stamp = '%s.%09d %s' % (time.strftime('%Y-%m-%d %H:%M:%S', mtime), ns,
+                                time.strftime('%z', mtime))
+        return encode_path_line('%s %s\t%s\n' % (prefix, path, stamp))
+
+    def _compare(self):
+        self._old_lines = read_lines(self._old)
+        self._new_lines = read_lines(self._new)
+        runs = diff_lines(self._old_lines, self._new_lines)
+        self._groups = group_changes(runs, len(self._old_lines),
+                                     len(self._new_lines), self._context)
+
+    def groups(self):
+        """Returns hunks as returned by group_changes(), files are compared
+        on first call"""
+        if self._groups is None:
+            if self.is_binary():
+                self._groups = []
+            elif PROFILER:
+                PROFILER.call('compare', self._compare)()
+            else:
+                self._compare()
+        return self._groups
+
+    def is_binary(self):
+        """True if either file looks binary"""
+        nul = '\0'.encode()
+        for patch_map in (self._old, self._new):
+            if nul in patch_map.raw(0, BINARY_CHECK_SIZE):
+                return True
+        return False
+
+    def is_identical(self):
+        if self.is_binary():
+            return self._old.raw(0, len(self._old)) == \
+                    self._new.raw(0, len(self._new))
+        return not self.groups()
+
+    def _hunks(self):
+        """Yields tuple (header, old_addr, new_addr, lines) for each hunk,
+        lines is a list of (attr, line), line is without newline or a tuple
+        if it is the last one and has none"""
+        old_lines = self._old_lines
+        new_lines = self._new_lines
+        context = self._context
+        for group in self.groups():
+            i1 = max(group[0][0] - context, 0)
+            j1 = group[0][2] - (group[0][0] - i1)
+            i2 = min(group[-1][1] + context, len(old_lines))
+            j2 = group[-1][3] + (i2 - group[-1][1])
+            header = '@@ -%s +%s @@\n' % (_format_range(i1, i2),
+                                          _format_range(j1, j2))
+            old_addr = (i2 > i1 and i1 + 1 or i1, i2 - i1)
+            new_addr = (j2 > j1 and j1 + 1 or j1, j2 - j1)
+
+            lines = []
+            i = i1
+            for c1, c2, d1, d2 in group + [(i2, i2, j2, j2)]:
+                for line in old_lines[i:c1]:
+                    lines.append((COMMON, line))
+                for line in old_lines[c1:c2]:
+                    lines.append((OLD, line))
+                for line in new_lines[d1:d2]:
+                    lines.append((NEW, line))
+                i = c2
+            yield header.encode(), old_addr, new_addr, lines
+
+    def get_diffs(self, include=None, exclude=None):
+        """Returns a list of the Diff, empty if files are the same, binary or
+        the paths are not wanted (see path_matcher())"""
+        if (include or exclude) and not path_matcher(include, exclude)(
+                *self._paths):
+            return []
+        if not self.groups():
+            return []
+        newline = '\n'.encode()
+        buffer = LineBuffer()
+        hunks = []
+        for header, old_addr, new_addr, lines in self._hunks():
+            hunk = Hunk(header, old_addr, new_addr, buffer)
+            for attr, line in lines:
+                if isinstance(line, tuple):
+                    line = line[0]
+                hunk.append(attr, line + newline)
+            hunks.append(hunk)
+        buffer.flush()
+        return [Udiff(self._headers, self._path_line('---', self._paths[0]),
+                      self._path_line('+++', self._paths[1]), hunks)]
+
+    def __iter__(self):
+        if self.is_binary():
+            if not self.is_identical():
+                yield encode_path_line('Binary files %s and %s differ\n' %
+                                       self._paths)
+            return
+        if not self.groups():
+            return
+        newline = '\n'.encode()
+        no_eol = '\n\\ No newline at end of file\n'.encode()
+        for line in self._headers:
+            yield line
+        yield self._path_line('---', self._paths[0])
+        yield self._path_line('+++', self._paths[1])
+        for header, old_addr, new_addr, lines in self._hunks():
+            yield header
+            for attr, line in lines:
+                if isinstance(line, tuple):
+                    yield attr + line[0] + no_eol
+                else:
+                    yield attr + line + newline
+
+    def update_digest(self, digest):
+        for path in self._paths:
+            digest.update(self._path_line('', path))
+        self._old.update_digest(digest)
+        digest.update(repr(len(self._old)).encode())
+        self._new.update_digest(digest)
+
+    def close(self):
+        self._old.close()
+        self._new.close()
+
+
+# Threads checking files in both directories, reading is I/O bound and
+# hashlib releases the GIL on large buffers
+COMPARE_JOBS = 8
+
+
+def _list_dir(path):
+    """Returns dict of name -> True if it is a directory, for entries in
+    directory path, symlinks are followed as `diff -r` does"""
+    entries = {}
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(path):
+            try:
+                entries[entry.name] = entry.is_dir()
+            except OSError:
+                entries[entry.name] = False
+    else:
+        for name in os.listdir(path):
+            entries[name] = os.path.isdir(os.path.join(path, name))
+    return entries
+
+
+def _file_digest(path):
+    """SHA-1 of file content, read with os.read() as most files are small
+    and the cost is in the calls"""
+    import hashlib
+    digest = hashlib.sha1()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        while True:
+            data = os.read(fd, COPY_CHUNK_SIZE)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        os.close(fd)
+    return digest.digest()
+
+
+def _is_binary_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return '\0'.encode() in os.read(fd, BINARY_CHECK_SIZE)
+    finally:
+        os.close(fd)
+
+
+def _check_files(entry):
+    """Runs in a thread of DirPair, tells kind of an entry for a file in
+    both directories: 'same', 'text' or 'binary' if they differ, or 'error'
+    with the message.  Files of the same size are the same if they are one
+    file (same inode), otherwise if they have the same content hash, mtimes
+    of two trees tell nothing about content"""
+    kind, old_path, new_path = entry
+    if kind != 'file':
+        return entry
+    try:
+        old_st = os.stat(old_path)
+        new_st = os.stat(new_path)
+        if old_st.st_size == new_st.st_size:
+            if (old_st.st_dev, old_st.st_ino) == (new_st.st_dev,
+                                                  new_st.st_ino):
+                return ('same', old_path, new_path)
+            if _file_digest(old_path) == _file_digest(new_path):
+                return ('same', old_path, new_path)
+        if _is_binary_file(old_path) or _is_binary_file(new_path):
+            return ('binary', old_path, new_path)
+        return ('text', old_path, new_path)
+    except EnvironmentError:
+        e = sys.exc_info()[1]
+        return ('error', '%s: %s' % (e.filename, e.strerror), None)
+
+
+class DirPair(object):
+    """Two directories compared like `diff -ru`.  Files in both are checked
+    in a thread pool, only those that differ are read and compared, results
+    come in path order.  Iterating yields the lines of the patch"""
+
+    def __init__(self, old_dir, new_dir, include=None, exclude=None,
+                 jobs=COMPARE_JOBS):
+        """Only files with path relative to the directories matching a glob
+        in include and none in exclude are compared, see path_matcher()"""
+        self._dirs = (old_dir, new_dir)
+        self._jobs = jobs
+        self._match = None
+        if include or exclude:
+            self._match = path_matcher(include, exclude)
+        # Fail early like FilePair if either can't be read
+        _list_dir(old_dir)
+        _list_dir(new_dir)
+
+    def _walk(self, rel):
+        """Yields tuple (kind, old_path, new_path) for entries under rel, in
+        the order of `diff -r`, kind is 'file' for a file in both, 'only' for
+        an entry in one, then old_path is its directory and new_path its
+        name, or 'mismatch' for a file in one and a directory in the other"""
+        old_dir = os.path.join(self._dirs[0], rel)
+        new_dir = os.path.join(self._dirs[1], rel)
+        old = _list_dir(old_dir)
+        new = _list_dir(new_dir)
+        for name in sorted(set(old) | set(new)):
+            path = os.path.join(rel, name)
+            if old.get(name) and new.get(name):
+                for entry in self._walk(path):
+                    yield entry
+                continue
+            if self._match and not self._match(path, path):
+                continue
+            if name not in new:
+                yield ('only', old_dir.rstrip(os.sep), name)
+            elif name not in old:
+                yield ('only', new_dir.rstrip(os.sep), name)
+            elif old[name] or new[name]:
+                yield ('mismatch', os.path.join(old_dir, name),
+                       os.path.join(new_dir, name))
+            else:
+                yield ('file', os.path.join(old_dir, name),
+                       os.path.join(new_dir, name))
+
+    def _entries(self):
+        """Yields (kind, old_path, new_path) for entries that differ, see
+        _walk() and _check_files()"""
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(self._jobs)
+        try:
+            for entry in pool.imap(_check_files, self._walk(''), 16):
+                if entry[0] != 'same':
+                    yield entry
+        finally:
+            pool.terminate()
+
+    def _items(self):
+        """Yields for each entry that differs a FilePair, or the line
+        reporting it"""
+        for kind, old_path, new_path in self._entries():
+            if kind == 'text':
+                header = encode_path_line('diff -ru %s %s\n' %
+                                          (old_path, new_path))
+                try:
+                    yield FilePair(old_path, new_path, headers=[header])
+                except EnvironmentError:
+                    e = sys.exc_info()[1]
+                    sys.stderr.write('*** %s: %s\n' % (e.filename,
+                                                       e.strerror))
+            elif kind == 'error':
+                sys.stderr.write('*** %s\n' % old_path)
+            elif kind == 'binary':
+                yield encode_path_line('Binary files %s and %s differ\n' %
+                                       (old_path, new_path))
+            elif kind == 'only':
+                yield encode_path_line('Only in %s: %s\n' %
+                                       (old_path, new_path))
+            else:
+                if os.path.isdir(old_path):
+                    kinds = ('directory', 'regular file')
+                else:
+                    kinds = ('regular file', 'directory')
+                yield encode_path_line(
+                        'File %s is a %s while file %s is a %s\n' %
+                        (old_path, kinds[0], new_path, kinds[1]))
+
+    def get_diffs(self):
+        """Returns a generator of Diff objects, a file reported by a line is
+        a Diff with only the line as header"""
+        for item in self._items():
+            if isinstance(item, FilePair):
+                try:
+                    for diff in item.get_diffs():
+                        yield diff
+                finally:
+                    item.close()
+            else:
+                yield Udiff([item], None, None, [])
+
+    def __iter__(self):
+        for item in self._items():
+            if isinstance(item, FilePair):
+                try:
+                    for line in item:
+                        yield line
+                finally:
+                    item.close()
+            else:
+                yield item
+
+    def update_digest(self, digest):
+        """Feed path and content hash of every file, mtime is not enough as a
+        file rewritten within its timestamp granularity keeps it"""
+        for top in self._dirs:
+            digest.update(encode_path_line(top + '\0'))
+            for root, dirs, files in os.walk(top):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    try:
+                        content = _file_digest(path)
+                    except EnvironmentError:
+                        continue
+                    digest.update(encode_path_line(path + '\0'))
+                    digest.update(content)
+
+    def close(self):
+        pass
+
+
+# Bytes of input counted at a time by --stat
+STAT_CHUNK_SIZE = 1024 * 1024
+
+
+# Lines that end a hunk body, their prefixes never start a body line
+BODY_ENDS = (HUNK_HEADER, DIFF_COMMAND)
+
+
+def read_chunks(source, size=STAT_CHUNK_SIZE):
+    """Yields content of source as chunks of bytes, lines may be cut between
+    chunks.  source is a PatchMap, a binary file object, or an iterable of
+    lines such as a FilePair"""
+    if isinstance(source, PatchMap):
+        for pos in range(0, len(source), size):
+            yield source.raw(pos, pos + size)
+    elif hasattr(source, 'read'):
+        while True:
+            data = source.read(size)
+            if not data:
+                break
+            yield data
+    else:
+        batch = []
+        batch_size = 0
+        for line in source:
+            batch.append(line)
+            batch_size += len(line)
+            if batch_size >= size:
+                yield EMPTY.join(batch)
+                batch = []
+                batch_size = 0
+        if batch:
+            yield EMPTY.join(batch)
+
+
+class DiffStat(object):
+    """Lines added and removed per file, counted in one pass over a patch.
+    Hunk bodies are skipped by the line counts in hunk headers and their
+    lines are counted by prefix on whole runs of bytes, no Diff or Hunk
+    objects are made"""
+
+    def __init__(self):
+        self.files = []         # [path, added, removed, binary]
+        self._difflet = Udiff(None, None, None, None)
+        self._entry = None
+        self._awaiting_path = False     # entry is from a 'diff ' line
+        self._git = False
+        self._old_path = None
+        self._old_left = 0
+        self._new_left = 0
+        self._pending = EMPTY
+
+    def feed(self, chunk):
+        """Count bytes chunk of the patch, a line may be cut at its end"""
+        newline = '\n'.encode()
+        new_mark = newline + NEW
+        old_mark = newline + OLD
+        eof_mark = newline + EOF_MARK
+        # Every line follows a newline, lines starting with a prefix are
+        # counted as occurrences of newline + prefix
+        data = newline + self._pending + chunk
+        end = data.rfind(newline) + 1
+        self._pending = data[end:]
+        body_ends = [[newline + prefix, 0] for prefix in BODY_ENDS]
+        pos = 1
+        while pos < end:
+            if self._old_left <= 0 and self._new_left <= 0:
+                next_pos = data.find(newline, pos) + 1
+                self._header(data[pos:next_pos - 1])
+                pos = next_pos
+                continue
+
+            # Take lines up to the next line ending a body at once if their
+            # counts fit in the hunk, lines of other prefixes are taken as
+            # common so that any header among them does not fit
+            stop = end
+            for body_end in body_ends:
+                if body_end[1] < pos:
+                    found = data.find(body_end[0], pos - 1, end)
+                    body_end[1] = found < 0 and end or found + 1
+                stop = min(stop, body_end[1])
+            added = data.count(new_mark, pos - 1, stop - 1)
+            removed = data.count(old_mark, pos - 1, stop - 1)
+            common = data.count(newline, pos, stop) - added - removed
+            if common + removed > self._old_left or \
+                    common + added > self._new_left:
+                common -= data.count(eof_mark, pos - 1, stop - 1)
+            if stop > pos and common + removed <= self._old_left and \
+                    common + added <= self._new_left:
+                pos = stop
+                self._count(added, removed, common)
+                continue
+
+            # Runs into headers of next file, e.g. patches of svn or plain
+            # `diff -u` with no 'diff ' line, counted line by line
+            while pos < end and (self._old_left > 0 or self._new_left > 0):
+                attr = data[pos:pos + 1]
+                if attr == NEW:
+                    self._count(1, 0, 0)
+                elif attr == OLD:
+                    self._count(0, 1, 0)
+                elif attr in (COMMON, newline):
+                    self._count(0, 0, 1)
+                elif attr != EOF_MARK:
+                    # Hunk shorter than its header says
+                    self._old_left = self._new_left = 0
+                    break
+                pos = data.find(newline, pos) + 1
+
+    def _count(self, added, removed, common):
+        self._old_left -= common + removed
+        self._new_left -= common + added
+        self._entry[1] += added
+        self._entry[2] += removed
+
+    def finish(self):
+        """Count the last line if it has no newline"""
+        if self._pending:
+            self._pending, line = EMPTY, self._pending
+            self.feed(line + '\n'.encode())
+
+    def _new_entry(self, path):
+        self._entry = [path, 0, 0, False]
+        self.files.append(self._entry)
+
+    def _path(self, path):
+        if self._git and path[:2] in ('a/', 'b/'):
+            return path[2:]
+        return path
+
+    def _header(self, line):
+        if line.startswith(HUNK_HEADER):
+            if self._entry is None:
+                self._new_entry('?')
+            self._awaiting_path = False
+            old_addr, new_addr = self._difflet.parse_hunk_header(line)
+            self._old_left = old_addr[1]
+            self._new_left = new_addr[1]
+        elif line.startswith(OLD_PATH):
+            self._old_path = path_of(line)
+        elif line.startswith(NEW_PATH):
+            path = path_of(line)
+            if path == '/dev/null' and self._old_path:
+                path = self._old_path
+            path = self._path(path)
+            if self._awaiting_path:
+                self._entry[0] = path
+                self._awaiting_path = False
+            else:
+                self._new_entry(path)
+        elif line.startswith(DIFF_COMMAND):
+            # 'diff --git a/path b/path' or 'diff -ru old new', the file
+            # may have no hunks, e.g. if binary
+            self._git = line.startswith(DIFF_GIT)
+            self._old_path = None
+            paths = diff_paths(line) or ('?', '?')
+            self._new_entry(self._path(paths[1]))
+            self._awaiting_path = True
+        elif line.startswith(BINARY_FILES):
+            # 'Binary files old and new differ', new is /dev/null if deleted
+            old, new = diff_paths(line)
+            path = self._path(new == '/dev/null' and old or new)
+            if self._awaiting_path:
+                self._entry[0] = path
+            else:
+                self._new_entry(path)
+            self._entry[3] = True
+            self._awaiting_path = False
+
+    def merged(self):
+        """Entries added up per path in order of first appearance, like
+        `git diff --stat` of a range for `git log -p`.  A path is binary
+        only if all its entries are"""
+        entries = {}
+        files = []
+        for path, added, removed, binary in self.files:
+            entry = entries.get(path)
+            if entry is None:
+                entry = entries[path] = [path, added, removed, binary]
+                files.append(entry)
+            else:
+                entry[1] += added
+                entry[2] += removed
+                entry[3] = entry[3] and binary
+        return files
+
+    def format(self, width, color=True, include=None, exclude=None):
+        """Returns list of output lines like `git diff --stat`, bars are
+        scaled to fit width"""
+        files = self.merged()
+        if include or exclude:
+            match = path_matcher(include, exclude)
+            files = [entry for entry in files if match(entry[0], entry[0])]
+        if not files:
+            return []
+
+        max_change = max([added + removed for _, added, removed, _ in files])
+        count_width = len(str(max_change))
+        if [entry for entry in files if entry[3]]:
+            count_width = max(count_width, len('Bin'))
+        name_width = max([display_width(entry[0]) for entry in files])
+        # At least room for a bar of 10, long names are cut from the left
+        name_width = min(name_width, max(width - count_width - 16, 10))
+        graph_width = max(width - name_width - count_width - 6, 1)
+
+        r = get_renderer()
+        out = []
+        total_added = total_removed = 0
+        for path, added, removed, binary in files:
+            total_added += added
+            total_removed += removed
+            if display_width(path) > name_width:
+                path = '...' + path[-(name_width - 3):]
+            name = path + ' ' * (name_width - display_width(path))
+            if binary:
+                out.append(' %s | %s\n' % (name, 'Bin'.rjust(count_width)))
+                continue
+            plus, minus = _scale_stat(added, removed, graph_width, max_change)
+            plus = '+' * plus
+            minus = '-' * minus
+            if color:
+                plus = plus and r.new % plus
+                minus = minus and r.old % minus
+            out.append(' %s | %s %s%s\n' % (
+                    name, str(added + removed).rjust(count_width), plus,
+                    minus))
+
+        summary = ' %d file%s changed' % (len(files),
+                                          len(files) != 1 and 's' or '')
+        if total_added:
+            summary += ', %d insertion%s(+)' % (total_added,
+                                                total_added != 1 and 's' or '')
+        if total_removed:
+            summary += ', %d deletion%s(-)' % (
+                    total_removed, total_removed != 1 and 's' or '')
+        out.append(summary + '\n')
+        return out
+
+
+def _scale_stat(added, removed, width, max_change):
+    """Bar lengths of added and removed lines, as git does"""
+    if max_change <= width:
+        return added, removed
+
+    def scale(n):
+        return n and 1 + n * (width - 1) // max_change
+
+    total = scale(added + removed)
+    if total < 2 and added and removed:
+        total = 2
+    if added < removed:
+        added = scale(added)
+        return added, total - added
+    removed = scale(removed)
+    return total - removed, removed
 
-    def _markup_traditional(self):
+
+# Input with fewer hunk lines than this is rendered inline even if parallel
+# jobs are requested, to not pay for the pool startup
+PARALLEL_MIN_LINES = 5000
+
+# Max number of rendered diffs per job waiting in the reorder buffer
+PARALLEL_BACKLOG = 4
+
+
+def _render_diff(diff, side_by_side, width, diff_engine):
+    if side_by_side:
+        return diff.markup_side_by_side(width, diff_engine)
+    else:
+        return diff.markup_traditional(diff_engine)
+
+
+def _iter_markup_diff(diff, side_by_side, width, diff_engine):
+    """Render one Diff in this process, profiled per file"""
+    if PROFILER:
+        return PROFILER.iterate('markup', _render_diff, diff, side_by_side,
+                width, diff_engine, path=diff.get_path())
+    return _render_diff(diff, side_by_side, width, diff_engine)
+
+
+def _markup_diff(diff, side_by_side, width, diff_engine):
+    """Render one Diff to a list of lines, runs in worker process.  Returns
+    tuple (lines, seconds, intraline cache hits, misses) for the profiler of
+    the parent"""
+    hits, misses = INTRALINE_CACHE.hits, INTRALINE_CACHE.misses
+    start = time.time()
+    lines = list(_render_diff(diff, side_by_side, width, diff_engine))
+    return (lines, time.time() - start, INTRALINE_CACHE.hits - hits,
+            INTRALINE_CACHE.misses - misses)
+
+
+def _init_worker(max_hunk_lines, max_line_length, max_intraline_work,
+                 fallback_encoding):
+    """Pool initializer, workers may not inherit settings of main().  A
+    forked worker doesn't profile, its jobs are timed by the parent"""
+    global MAX_HUNK_LINES, MAX_LINE_LENGTH, MAX_INTRALINE_WORK, \
+        FALLBACK_ENCODING, PROFILER
+    PROFILER = None
+    MAX_HUNK_LINES = max_hunk_lines
+    MAX_LINE_LENGTH = max_line_length
+    MAX_INTRALINE_WORK = max_intraline_work
+    FALLBACK_ENCODING = fallback_encoding
+
+
+def _make_pool(jobs):
+    """Process pool, or thread pool where multiprocessing is not usable"""
+    try:
+        import multiprocessing
+        return multiprocessing.Pool(jobs, _init_worker, (MAX_HUNK_LINES,
+                MAX_LINE_LENGTH, MAX_INTRALINE_WORK, FALLBACK_ENCODING))
+    except (ImportError, OSError):
+        from multiprocessing.pool import ThreadPool
+        return ThreadPool(jobs)
+
+
+class DiffMarkup(object):
+
+    def __init__(self, stream, include=None, exclude=None):
+        """stream is lines of a patch, a PatchMap, or a FilePair or DirPair
+        which give Diff objects without a patch being parsed"""
+        if isinstance(stream, FilePair):
+            self._diffs = iter(stream.get_diffs(include, exclude))
+        elif isinstance(stream, DirPair):
+            # Paths are filtered by DirPair as it walks
+            self._diffs = stream.get_diffs()
+        else:
+            self._diffs = DiffParser(stream, include, exclude).get_diffs()
+        if PROFILER:
+            self._diffs = PROFILER.iterate('parse', iter, self._diffs)
+
+    def markup(self, side_by_side=False, width=0,
+            diff_engine=DEFAULT_DIFF_ENGINE, jobs=1):
+        """Returns a generator, diff_engine is a key of DIFF_ENGINES to select
+        the intraline diff implementation, jobs > 1 renders diffs in a pool
+        of worker processes"""
+        if diff_engine not in DIFF_ENGINES:
+            raise ValueError('unknown diff engine: %s' % diff_engine)
+        if jobs > 1:
+            return self._markup_parallel(side_by_side, width, diff_engine,
+                    jobs)
+        elif side_by_side:
+            return self._markup_side_by_side(width, diff_engine)
+        else:
+            return self._markup_traditional(diff_engine)
+
+    def _markup_traditional(self, diff_engine):
         for diff in self._diffs:
-            for line in diff.markup_traditional():
+            if PROFILER:
+                lines = PROFILER.iterate('markup', diff.markup_traditional,
+                        diff_engine, path=diff.get_path())
+            else:
+                lines = diff.markup_traditional(diff_engine)
+            for line in lines:
                 yield line
 
-    def _markup_side_by_side(self, width):
+    def _markup_side_by_side(self, width, diff_engine):
         for diff in self._diffs:
-            for line in diff.markup_side_by_side(width):
+            if PROFILER:
+                lines = PROFILER.iterate('markup', diff.markup_side_by_side,
+                        width, diff_engine, path=diff.get_path())
+            else:
+                lines = diff.markup_side_by_side(width, diff_engine)
+            for line in lines:
                 yield line
 
+    def _markup_parallel(self, side_by_side, width, diff_engine, jobs):
+        """Render diffs in a worker pool, results are yielded in original
+        order with at most jobs * PARALLEL_BACKLOG diffs in flight"""
+        args = (side_by_side, width, diff_engine)
 
-def markup_to_pager(stream, opts):
-    markup = DiffMarkup(stream)
+        head = []
+        line_count = 0
+        for diff in self._diffs:
+            head.append(diff)
+            line_count += diff.line_count()
+            if line_count >= PARALLEL_MIN_LINES:
+                break
+        else:
+            for diff in head:
+                for line in _iter_markup_diff(diff, *args):
+                    yield line
+            return
+
+        def collect(job):
+            path, result = job
+            lines, seconds, hits, misses = result.get()
+            if PROFILER:
+                PROFILER.add_job('markup', path, seconds, hits, misses)
+            return lines
+
+        import collections
+        pool = _make_pool(jobs)
+        try:
+            pending = collections.deque()
+            for diff in itertools.chain(head, self._diffs):
+                if diff.line_count() > MAX_HUNK_LINES:
+                    # Rendered here as it streams, not collected in a worker
+                    while pending:
+                        for line in collect(pending.popleft()):
+                            yield line
+                    for line in _iter_markup_diff(diff, *args):
+                        yield line
+                    continue
+                pending.append((diff.get_path(),
+                        pool.apply_async(_markup_diff, (diff,) + args)))
+                if len(pending) >= jobs * PARALLEL_BACKLOG:
+                    for line in collect(pending.popleft()):
+                        yield line
+            while pending:
+                for line in collect(pending.popleft()):
+                    yield line
+        finally:
+            pool.terminate()
+
+
+# Number of slowest files and hunks reported by the profiler
+PROFILE_TOP = 10
+
+# Order of stages in the report, in the order they happen
+PROFILE_STAGES = ('read', 'copy', 'compare', 'parse', 'intraline', 'markup',
+                  'write')
+
+
+class Profiler(object):
+    """Records wall time and call count of each stage, time of a stage is
+    exclusive of nested stages.  Installed as the global PROFILER only when
+    asked so nothing is recorded otherwise"""
+
+    def __init__(self):
+        self._start = time.time()
+        self._stages = {}       # stage -> [seconds, calls]
+        self._nested = []       # time spent in nested stages, per level
+        self._files = {}        # path -> seconds, of all its diffs
+        self._hunks = {}        # (path, hunk header) -> seconds, added up
+        self._path = None
+        self._jobs = 0          # diffs rendered in worker processes
+        self._job_counters = {'intraline_cache_hits': 0,
+                              'intraline_cache_misses': 0}
+
+    def _enter(self):
+        self._nested.append(0.0)
+        return time.time()
+
+    def _leave(self, stage, start, calls=1):
+        elapsed = time.time() - start
+        nested = self._nested.pop()
+        if self._nested:
+            self._nested[-1] += elapsed
+        record = self._stages.setdefault(stage, [0.0, 0])
+        record[0] += elapsed - nested
+        record[1] += calls
+        return elapsed
+
+    def iterate(self, stage, func, *args, **kwargs):
+        """Generator over func(*args), time of each step is recorded under
+        stage, and per file or hunk when keyword path or hunk is given.  A
+        path may have many diffs (e.g. in `git log -p`), their time is added
+        up"""
+        path = kwargs.get('path')
+        hunk = kwargs.get('hunk')
+        if path is not None:
+            self._path = path
+            key, table = path, self._files
+        elif hunk is not None:
+            key, table = (self._path, hunk.rstrip()), self._hunks
+        else:
+            key = table = None
+
+        start = self._enter()
+        try:
+            it = iter(func(*args))
+        finally:
+            elapsed = self._leave(stage, start)
+            if table is not None:
+                table[key] = table.get(key, 0.0) + elapsed
+        while True:
+            start = self._enter()
+            try:
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            finally:
+                # Steps of the generator are not counted as calls
+                elapsed = self._leave(stage, start, 0)
+                if table is not None:
+                    table[key] += elapsed
+            yield item
+
+    def call(self, stage, func):
+        """Wrap func so time of each call is recorded under stage"""
+        def wrapper(*args):
+            start = self._enter()
+            try:
+                return func(*args)
+            finally:
+                self._leave(stage, start)
+        return wrapper
+
+    def add_job(self, stage, path, seconds, hits, misses):
+        """Record a diff rendered by a worker process in seconds, with its
+        intraline cache hits and misses"""
+        record = self._stages.setdefault(stage, [0.0, 0])
+        record[0] += seconds
+        record[1] += 1
+        self._files[path] = self._files.get(path, 0.0) + seconds
+        self._jobs += 1
+        self._job_counters['intraline_cache_hits'] += hits
+        self._job_counters['intraline_cache_misses'] += misses
+
+    def result(self):
+        counters = {
+            'intraline_cache_hits': INTRALINE_CACHE.hits +
+                self._job_counters['intraline_cache_hits'],
+            'intraline_cache_misses': INTRALINE_CACHE.misses +
+                self._job_counters['intraline_cache_misses'],
+        }
+        stages = {}
+        for stage, (seconds, calls) in self._stages.items():
+            stages[stage] = {'seconds': seconds, 'calls': calls}
+        files = sorted(self._files.items(), key=lambda x: -x[1])
+        hunks = sorted(self._hunks.items(), key=lambda x: -x[1])
+        return {
+            'total_seconds': time.time() - self._start,
+            'worker_jobs': self._jobs,
+            'stages': stages,
+            'counters': counters,
+            'slowest_files': [{'path': path, 'seconds': seconds}
+                              for path, seconds in files[:PROFILE_TOP]],
+            'slowest_hunks': [{'path': key[0], 'hunk': key[1],
+                               'seconds': seconds}
+                              for key, seconds in hunks[:PROFILE_TOP]],
+        }
+
+    def report(self, out):
+        result = self.result()
+        out.write('Total %.3fs\n\n' % result['total_seconds'])
+        out.write('%-12s %10s %10s\n' % ('stage', 'seconds', 'calls'))
+        stages = result['stages']
+        order = [stage for stage in PROFILE_STAGES if stage in stages]
+        for stage in order + sorted(set(stages) - set(order)):
+            record = stages[stage]
+            out.write('%-12s %10.4f %10d\n' %
+                      (stage, record['seconds'], record['calls']))
+        if result['worker_jobs']:
+            out.write('\n%d files were rendered by worker processes, their '
+                      'markup time is the time\nin a worker and includes '
+                      'intraline, their hunks are not timed\n' %
+                      result['worker_jobs'])
+        out.write('\n')
+        for name, value in sorted(result['counters'].items()):
+            out.write('%-24s %10d\n' % (name, value))
+        if result['slowest_files']:
+            out.write('\nSlowest files:\n')
+            for item in result['slowest_files']:
+                out.write('%10.4f  %s\n' % (item['seconds'], item['path']))
+        if result['slowest_hunks']:
+            out.write('\nSlowest hunks:\n')
+            for item in result['slowest_hunks']:
+                out.write('%10.4f  %s %s\n' %
+                          (item['seconds'], item['path'], item['hunk']))
+
+
+# Global Profiler instance, None unless --profile is given
+PROFILER = None
+
+
+def write_lines(lines, out, chunk_size=OUTPUT_CHUNK_SIZE):
+    """Write rendered lines to binary file object out, lines are gathered
+    into chunks so encoding and writing is done once per chunk"""
+    def write_chunk(chunk):
+        out.write(''.join(chunk).encode('utf-8'))
+    if PROFILER:
+        write_chunk = PROFILER.call('write', write_chunk)
+
+    limit = min(OUTPUT_FIRST_CHUNK_SIZE, chunk_size)
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= limit:
+            write_chunk(chunk)
+            chunk = []
+            size = 0
+            limit = min(limit * 2, chunk_size)
+    if chunk:
+        write_chunk(chunk)
+    out.flush()
+
+
+def copy_stream(src, dst):
+    """Copy binary file object src to dst till end of src, without looking
+    at the content.  Done in kernel with os.sendfile() from a regular file or
+    os.splice() from a pipe when the platform has them, by a read and write
+    loop otherwise.  Returns number of bytes copied"""
+    dst.flush()
+    try:
+        in_fd = src.fileno()
+        out_fd = dst.fileno()
+    except (AttributeError, ValueError, EnvironmentError):
+        # Not backed by a file descriptor
+        return _copy_file_objects(src, dst)
+
+    mode = os.fstat(in_fd).st_mode
+    if stat.S_ISREG(mode) and hasattr(os, 'sendfile'):
+        # Explicit offset leaves file position alone, read loop below can
+        # still start over from it
+        offset = os.lseek(in_fd, 0, os.SEEK_CUR)
+
+        def move(count):
+            return os.sendfile(out_fd, in_fd, offset + copied, count)
+    elif stat.S_ISFIFO(mode) and hasattr(os, 'splice'):
+        def move(count):
+            return os.splice(in_fd, out_fd, count)
+    else:
+        move = None
+
+    copied = 0
+    if move:
+        try:
+            while True:
+                size = move(COPY_CHUNK_SIZE)
+                if not size:
+                    return copied
+                copied += size
+        except EnvironmentError:
+            import errno
+            # Not supported for this pair of files, e.g. sendfile() to a
+            # non-socket on some systems or splice() to an append-only file
+            if copied or sys.exc_info()[1].errno == errno.EPIPE:
+                raise
+
+    while True:
+        # os.read() returns what a pipe has so far, the output keeps pace
+        # with a slow producer
+        data = os.read(in_fd, COPY_CHUNK_SIZE)
+        if not data:
+            return copied
+        copied += len(data)
+        while data:
+            data = data[os.write(out_fd, data):]
+
+
+def _copy_file_objects(src, dst):
+    copied = 0
+    while True:
+        data = src.read(COPY_CHUNK_SIZE)
+        if not data:
+            break
+        dst.write(data)
+        copied += len(data)
+    dst.flush()
+    return copied
+
+
+def markup_to_pager(stream, opts, cache_entry=None):
+    """Render stream to pager, output is saved to cache_entry (see
+    RenderCache.create()) as well if given and kept if rendered to the end"""
+    markup = DiffMarkup(stream, opts.include, opts.exclude)
     color_diff = markup.markup(side_by_side=opts.side_by_side,
-            width=opts.width)
+            width=opts.width, diff_engine=opts.diff_engine, jobs=opts.jobs)
+
+    def write(out):
+        if cache_entry:
+            out = CacheTee(out, cache_entry)
+        write_lines(color_diff, out)
+
+    done = False
+    try:
+        done = run_pager(write, color_diff.close, opts)
+    finally:
+        if cache_entry:
+            if done:
+                cache_entry.commit()
+            else:
+                cache_entry.discard()
+
+
+def stat_to_pager(stream, opts):
+    """Count lines added and removed per file in stream, a PatchMap, binary
+    file object or iterable of lines, and show them like `git diff --stat`.
+    Output is colored and paged if stdout is a terminal"""
+    stat = DiffStat()
+    feed = stat.feed
+    if PROFILER:
+        feed = PROFILER.call('parse', feed)
+    for chunk in read_chunks(stream):
+        feed(chunk)
+    stat.finish()
+
+    tty = sys.stdout.isatty()
+    width = 80
+    if tty and hasattr(os, 'get_terminal_size'):
+        try:
+            columns = os.get_terminal_size(sys.stdout.fileno()).columns
+        except (OSError, ValueError):
+            columns = 0
+        # Some ptys (serial consoles, containers) report 0 columns, unknown
+        if columns > 0:
+            width = columns
+    lines = stat.format(width, tty, opts.include, opts.exclude)
+    if not tty:
+        write_lines(lines, getattr(sys.stdout, 'buffer', sys.stdout))
+        return
+    if lines:
+        run_pager(lambda out: write_lines(lines, out), lambda: None, opts)
+
+
+def replay_to_pager(path, opts):
+    """Send output saved in render cache to pager"""
+    f = open(path, 'rb')
+
+    def write(out):
+        while True:
+            data = f.read(OUTPUT_CHUNK_SIZE)
+            if not data:
+                break
+            out.write(data)
+        out.flush()
+
+    run_pager(write, f.close, opts)
+
+
+def run_pager(write, cleanup, opts):
+    """Start pager and call write() with its stdin, cleanup() is called when
+    writing ends, before waiting for the pager to exit.  Returns True if all
+    output is written"""
+    import subprocess
+    import shlex
+    import threading
+    try:
+        from _thread import interrupt_main
+    except ImportError:
+        from thread import interrupt_main
+
+    if CLIENT:
+        # Rendering for a client of --server, pager runs in the client
+        pager_stdin, wait_pager = CLIENT.start_pager(shlex.split(opts.pager))
+    else:
+        argv = shlex.split(opts.pager)
+        try:
+            pager = subprocess.Popen(argv, bufsize=OUTPUT_CHUNK_SIZE,
+                    stdin=subprocess.PIPE, stdout=sys.stdout)
+        except OSError:
+            e = sys.exc_info()[1]
+            sys.stderr.write('*** Can not run pager %s: %s\n'
+                             % (argv[0], e.strerror))
+            cleanup()
+            raise SystemExit(1)
+        pager_stdin, wait_pager = pager.stdin, pager.wait
+
+    # Rendering is driven by pager reading its stdin, once user quits the
+    # pager the main thread is interrupted right away instead of finishing
+    # current file or hunk and waiting for next write to fail with EPIPE
+    lock = threading.Lock()
+    state = {'writing': True}
+
+    def watch_pager():
+        wait_pager()
+        lock.acquire()
+        try:
+            if state['writing']:
+                state['writing'] = False
+                interrupt_main()
+        finally:
+            lock.release()
+
+    def stop_watching():
+        lock.acquire()
+        try:
+            state['writing'] = False
+        finally:
+            lock.release()
 
-    # args stolen fron git source: github.com/git/git/blob/master/pager.c
-    pager = subprocess.Popen(['less', '-FRSXK'],
-            stdin=subprocess.PIPE, stdout=sys.stdout)
-    for line in color_diff:
-        pager.stdin.write(line.encode('utf-8'))
+    watcher = threading.Thread(target=watch_pager)
+    watcher.daemon = True
+    watcher.start()
 
-    pager.stdin.close()
-    pager.wait()
+    done = False
+    try:
+        try:
+            write(pager_stdin)
+            stop_watching()
+            pager_stdin.close()
+            done = True
+        except KeyboardInterrupt:
+            # Pager has quit, or user pressed Ctrl-C which also quits less
+            pass
+        except IOError:
+            e = sys.exc_info()[1]
+            import errno
+            if e.errno != errno.EPIPE:
+                raise
+    finally:
+        # Closing pager on error must not interrupt and hide the error
+        stop_watching()
+        cleanup()
+        try:
+            pager_stdin.close()
+        except IOError:
+            pass
+        watcher.join()
+    if CLIENT and CLIENT.pager_status == PAGER_NOT_RUN:
+        # Client has told why, exit as the pager not run in process does
+        raise SystemExit(1)
+    return done
+
+
+# Default max total size of rendered output kept in cache dir, in MB
+CACHE_SIZE = 200
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'cdiff')
+
+
+class RenderCache(object):
+    """Rendered output saved in a directory, one file by hash of input and
+    render options.  Least recently used files are removed once the total
+    size is over max_size, use is tracked by file mtime"""
+
+    def __init__(self, directory, max_size):
+        self._dir = directory
+        self._max_size = max_size
+
+    def _path(self, key):
+        return os.path.join(self._dir, key)
+
+    def lookup(self, key):
+        """Returns path of saved output or None"""
+        path = self._path(key)
+        try:
+            os.utime(path, None)
+        except EnvironmentError:
+            return None
+        return path
+
+    def create(self, key):
+        """Returns a CacheEntry to save output to, None if the cache dir is
+        not writable"""
+        path = self._path(key)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            if not os.path.isdir(self._dir):
+                os.makedirs(self._dir, 448)     # 0700
+            return CacheEntry(self, tmp_path, path)
+        except EnvironmentError:
+            return None
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self._dir):
+            path = self._path(name)
+            try:
+                st = os.stat(path)
+            except EnvironmentError:
+                continue
+            if name.endswith('.tmp'):
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self._max_size:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+            except EnvironmentError:
+                pass
+
+
+class CacheEntry(object):
+    """Output being saved to a temp file in cache dir, the file is moved to
+    its place on commit() so readers never see partial output"""
+
+    def __init__(self, cache, tmp_path, path):
+        self._cache = cache
+        self._tmp_path = tmp_path
+        self._path = path
+        self._file = open(tmp_path, 'wb')
+
+    def write(self, data):
+        if self._file:
+            try:
+                self._file.write(data)
+            except EnvironmentError:
+                # e.g. disk full, viewing goes on without caching
+                self.discard()
+
+    def commit(self):
+        if not self._file:
+            return
+        try:
+            self._file.close()
+            self._file = None
+            os.rename(self._tmp_path, self._path)
+            self._cache.evict()
+        except EnvironmentError:
+            self.discard()
+
+    def discard(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        try:
+            os.unlink(self._tmp_path)
+        except EnvironmentError:
+            pass
+
+
+class CacheTee(object):
+    """Binary file object writing to out and a CacheEntry"""
+
+    def __init__(self, out, cache_entry):
+        self._out = out
+        self._cache_entry = cache_entry
+
+    def write(self, data):
+        self._out.write(data)
+        self._cache_entry.write(data)
+
+    def flush(self):
+        self._out.flush()
+
+
+def _digest_lines(lines, digest):
+    for line in lines:
+        digest.update(line)
+        yield line
+
+
+def cached_markup_to_pager(stream, opts, cache):
+    """Replay output saved in cache if the same input was rendered with the
+    same options before, otherwise render and save it.  Input from a pipe
+    has to be read to the end before the cache is looked up"""
+    import hashlib
+    digest = hashlib.sha1()
+    options = (META_INFO['version'], opts.side_by_side, opts.width,
+               opts.diff_engine, MAX_HUNK_LINES, MAX_LINE_LENGTH,
+               MAX_INTRALINE_WORK, FALLBACK_ENCODING, opts.include,
+               opts.exclude)
+    digest.update(repr(options).encode('utf-8'))
+    if isinstance(stream, (PatchMap, FilePair, DirPair)):
+        stream.update_digest(digest)
+    else:
+        stream = list(_digest_lines(stream, digest))
+    key = digest.hexdigest()
+
+    path = cache.lookup(key)
+    if path:
+        try:
+            replay_to_pager(path, opts)
+            return
+        except EnvironmentError:
+            # Removed by another cdiff evicting, render again
+            pass
+    markup_to_pager(stream, opts, cache.create(key))
 
 
 def check_command_status(arguments):
     """Return True if command returns 0."""
+    import subprocess
     try:
         return subprocess.call(
             arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE) == 0
@@ -544,25 +3175,489 @@ def check_command_status(arguments):
         return False
 
 
+# Size of each read from the diff pipe, and max number of chunks read ahead
+# of the parser
+PIPE_CHUNK_SIZE = 65536
+PIPE_QUEUE_SIZE = 256
+
+
+class PipeReader(object):
+    """Drain a pipe in a background thread into a bounded queue, so the
+    process producing the diff keeps running while earlier lines are being
+    parsed and rendered instead of blocking on a full pipe.  Iterating
+    yields undecoded lines."""
+
+    def __init__(self, fileobj):
+        import threading
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+
+        self._fd = fileobj.fileno()
+        self._queue = queue.Queue(PIPE_QUEUE_SIZE)
+        self._empty = queue.Empty
+        self._stopped = False
+        self._error = None
+        self._thread = threading.Thread(target=self._read)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read(self):
+        try:
+            try:
+                while not self._stopped:
+                    data = os.read(self._fd, PIPE_CHUNK_SIZE)
+                    if not data:
+                        break
+                    self._queue.put(data)
+            except EnvironmentError:
+                self._error = sys.exc_info()[1]
+        finally:
+            self._queue.put(None)
+
+    def __iter__(self):
+        newline = '\n'.encode()
+        pending = None
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            if pending:
+                data = pending + data
+            start = 0
+            while True:
+                end = data.find(newline, start) + 1
+                if not end:
+                    break
+                yield data[start:end]
+                start = end
+            pending = data[start:]
+        if self._error:
+            raise self._error
+        if pending:
+            yield pending
+
+    def close(self):
+        """Stop reading, the producer should be terminated after this so a
+        blocking read returns"""
+        self._stopped = True
+        try:
+            while True:
+                self._queue.get_nowait()
+        except self._empty:
+            pass
+
+
+# Cache of detect_vcs() result by directory
+_VCS_CACHE = {}
+
+
+def detect_vcs(path=None):
+    """Return name of revision control system of the workspace path (default
+    is cwd) is in by looking for markers in path and its parents, None if
+    not found.  Results are cached for every directory walked through."""
+    if path is None and os.environ.get('GIT_DIR'):
+        return 'git'
+    path = os.path.abspath(path or os.getcwd())
+    visited = []
+    vcs = None
+    while True:
+        if path in _VCS_CACHE:
+            vcs = _VCS_CACHE[path]
+            break
+        visited.append(path)
+        for marker, name in VCS_MARKERS:
+            if os.path.exists(os.path.join(path, marker)):
+                vcs = name
+                break
+        if vcs:
+            break
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+
+    for path in visited:
+        _VCS_CACHE[path] = vcs
+    return vcs
+
+
 def revision_control_diff():
-    """Return diff from revision control system."""
+    """Return diff process of revision control system."""
+    import subprocess
+    vcs = detect_vcs()
+    if vcs:
+        for check, diff in REVISION_CONTROL:
+            if check[0] == vcs:
+                try:
+                    return subprocess.Popen(diff, stdout=subprocess.PIPE)
+                except OSError:
+                    # Tool not installed, try probing others
+                    break
+
     for check, diff in REVISION_CONTROL:
         if check_command_status(check):
-            return subprocess.Popen(diff, stdout=subprocess.PIPE).stdout
+            return subprocess.Popen(diff, stdout=subprocess.PIPE)
+
+
+def terminate(proc):
+    """Terminate the diff process if it has not finished"""
+    if proc.poll() is None:
+        import signal
+        try:
+            os.kill(proc.pid, signal.SIGTERM)
+        except OSError:
+            pass
+    proc.wait()
+
+
+# Tag of the server protocol, also ensures server runs the same cdiff
+SERVER_PROTOCOL = 'cdiff-server 2'
+
+# Exit status of the pager process of a client when the pager can't be run,
+# as a shell gives for a command not found
+PAGER_NOT_RUN = 127
+
+# Connection to the client when rendering in a --server process, see
+# ClientConnection
+CLIENT = None
+
+
+def server_socket_path():
+    """Unix socket of --server, in a dir only the user can access"""
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if base:
+        return os.path.join(base, 'cdiff.sock')
+    tmp = os.environ.get('TMPDIR') or '/tmp'
+    return os.path.join(tmp, 'cdiff-%d' % os.getuid(), 'cdiff.sock')
+
+
+def _is_private_dir(path):
+    try:
+        st = os.stat(path)
+    except EnvironmentError:
+        return False
+    return (stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and
+            not st.st_mode & 63)   # 077
+
+
+def _server_tag():
+    """Client and server must run the same code"""
+    return '%s %s %s' % (SERVER_PROTOCOL, META_INFO['version'],
+                         os.stat(os.path.abspath(__file__)).st_mtime)
+
+
+# The client side uses the C modules under socket and struct, importing
+# those would take longer than rendering a small diff in the server
+
+def _send_fds(sock, data, fds):
+    import _socket
+    import _struct
+    sock.sendmsg([data], [(_socket.SOL_SOCKET, _socket.SCM_RIGHTS,
+                           _struct.pack('%di' % len(fds), *fds))])
+
+
+def _recv_fds(sock, size, max_fds):
+    """Returns tuple (data, list of fds)"""
+    import _socket
+    import _struct
+    int_size = _struct.calcsize('i')
+    data, ancdata, flags, addr = sock.recvmsg(
+            size, _socket.CMSG_SPACE(max_fds * int_size))
+    fds = []
+    for level, kind, cdata in ancdata:
+        if level == _socket.SOL_SOCKET and kind == _socket.SCM_RIGHTS:
+            count = len(cdata) // int_size
+            fds.extend(_struct.unpack('%di' % count,
+                                      cdata[:count * int_size]))
+    return data, fds
+
+
+def _recv_line(sock):
+    """Messages are short lines, read byte by byte so nothing past the line
+    is consumed"""
+    data = []
+    while True:
+        char = sock.recv(1)
+        if not char:
+            return None
+        if char == '\n'.encode():
+            return ''.encode().join(data)
+        data.append(char)
+
+
+def run_client():
+    """Render in a running --server with stdin, stdout and stderr of this
+    process, returns exit status, or None if there is no usable server"""
+    path = server_socket_path()
+    if not os.path.exists(path) or not _is_private_dir(os.path.dirname(path)):
+        return None
+    import _socket
+    if not hasattr(_socket.socket, 'sendmsg'):
+        return None
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except _socket.error:
+            return None
+
+        fields = [_server_tag(), os.getcwd(), str(len(sys.argv))]
+        fields.extend(sys.argv)
+        fields.extend(['%s=%s' % item for item in os.environ.items()])
+        data = '\0'.join(fields).encode('utf-8', 'surrogateescape')
+        _send_fds(sock, ('%d\n' % len(data)).encode() + data, [0, 1, 2])
+
+        pager_pid = None
+        while True:
+            line = _recv_line(sock)
+            if line is None:
+                sys.stderr.write('*** cdiff server closed connection\n')
+                return 1
+            tag, value = line[:1].decode(), line[1:]
+            if tag == 'R':
+                # Rejected, e.g. server runs another version
+                return None
+            elif tag == 'P':
+                argv = value.decode('utf-8', 'surrogateescape').split('\0')
+                read_fd, write_fd = os.pipe()
+                pager_pid = os.fork()
+                if pager_pid == 0:
+                    try:
+                        os.close(write_fd)
+                        os.dup2(read_fd, 0)
+                        try:
+                            os.execvp(argv[0], argv)
+                        except OSError:
+                            e = sys.exc_info()[1]
+                            sys.stderr.write('*** Can not run pager %s: %s\n'
+                                             % (argv[0], e.strerror))
+                    finally:
+                        os._exit(PAGER_NOT_RUN)
+                os.close(read_fd)
+                _send_fds(sock, 'F\n'.encode(), [write_fd])
+                os.close(write_fd)
+                status = os.waitpid(pager_pid, 0)[1]
+                if os.WIFSIGNALED(status):
+                    status = 128 + os.WTERMSIG(status)
+                else:
+                    status = os.WEXITSTATUS(status)
+                sock.sendall(('Q%d\n' % status).encode())
+            elif tag == 'X':
+                return int(value)
+    finally:
+        sock.close()
+
+
+class ClientConnection(object):
+    """Client of --server, as seen by the forked process rendering for it"""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self.pager_status = None    # exit status of pager, once it exits
+
+    def start_pager(self, argv):
+        """Ask client to run pager, returns tuple (binary file object to the
+        stdin of the pager, function waiting till the pager exits)"""
+        data = '\0'.join(argv).encode('utf-8', 'surrogateescape')
+        self._sock.sendall('P'.encode() + data + '\n'.encode())
+        data, fds = _recv_fds(self._sock, 2, 1)
+        if not fds:
+            raise IOError('cdiff client did not start pager')
+        return os.fdopen(fds[0], 'wb', OUTPUT_CHUNK_SIZE), self._wait
+
+    def _wait(self):
+        line = _recv_line(self._sock)
+        if line and line[:1] == 'Q'.encode():
+            self.pager_status = int(line[1:])
+
+    def exit(self, status):
+        self._sock.sendall(('X%d\n' % status).encode())
+
+
+def _serve_client(sock):
+    """Runs in a forked process, set up as the client process and run main()
+    on its argv, returns exit status"""
+    global CLIENT
+
+    data, fds = _recv_fds(sock, 65536, 3)
+    try:
+        size, data = data.split('\n'.encode(), 1)
+        while len(data) < int(size):
+            chunk = sock.recv(65536)
+            if not chunk:
+                return 1
+            data += chunk
+        fields = data.decode('utf-8', 'surrogateescape').split('\0')
+        if fields[0] != _server_tag() or len(fds) != 3:
+            sock.sendall('R\n'.encode())
+            return 1
+    except ValueError:
+        sock.sendall('R\n'.encode())
+        return 1
+
+    cwd, argc = fields[1], int(fields[2])
+    argv = fields[3:3 + argc]
+    os.environ.clear()
+    for item in fields[3 + argc:]:
+        key, _, value = item.partition('=')
+        os.environ[key] = value
+    for fd, target in zip(fds, (0, 1, 2)):
+        os.dup2(fd, target)
+        os.close(fd)
+    os.chdir(cwd)
+    sys.argv = argv
+    CLIENT = ClientConnection(sock)
+
+    status = 1
+    try:
+        try:
+            status = main()
+        except SystemExit:
+            # --help, --version or bad option
+            status = sys.exc_info()[1].code
+            if not isinstance(status, int):
+                status = status and 1 or 0
+        except KeyboardInterrupt:
+            pass
+        except Exception:
+            import traceback
+            traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            CLIENT.exit(status)
+        except EnvironmentError:
+            pass
+    return status
+
+
+def _warm_up():
+    """Load modules and fill caches so forked processes start warm"""
+    make_parser()
+    lines = ['--- a\n', '+++ b\n', '@@ -1,2 +1,2 @@\n', ' same\n',
+             u'-old \u4e2d line\n', u'+new \u4e2d line\n']
+    for side_by_side in (False, True):
+        for diff_engine in DIFF_ENGINES:
+            markup = DiffMarkup(lines).markup(side_by_side, 80, diff_engine)
+            for _ in markup:
+                pass
+    import subprocess
+    import shlex
+    import threading
+    import hashlib
+    import traceback
+    import errno
+    import signal
+    import mmap
+    import collections
+    import fnmatch
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+    INTRALINE_CACHE.clear()
+
+
+def serve(path):
+    """Accept clients on Unix socket path, each is served in a forked
+    process so clients are rendered in parallel"""
+    import socket
+    import signal
+    if not hasattr(socket.socket, 'sendmsg'):
+        sys.stderr.write('*** --server requires python >= 3.3\n')
+        return 1
+
+    sock_dir = os.path.dirname(path)
+    if not os.path.isdir(sock_dir):
+        os.makedirs(sock_dir, 448)  # 0700
+    if not _is_private_dir(sock_dir):
+        sys.stderr.write('*** %s is accessible by others\n' % sock_dir)
+        return 1
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(path):
+        try:
+            sock.connect(path)
+            sys.stderr.write('*** cdiff server is running on %s\n' % path)
+            sock.close()
+            return 1
+        except socket.error:
+            os.unlink(path)
+            sock.close()
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+
+    _warm_up()
+    sock.bind(path)
+    sock.listen(16)
+    sys.stderr.write('cdiff server listening on %s\n' % path)
+    sys.stderr.flush()
+    try:
+        try:
+            while True:
+                conn = sock.accept()[0]
+                pid = os.fork()
+                if pid == 0:
+                    sock.close()
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    try:
+                        _serve_client(conn)
+                    finally:
+                        os._exit(0)
+                conn.close()
+                # Reap finished ones
+                try:
+                    while os.waitpid(-1, os.WNOHANG)[0]:
+                        pass
+                except OSError:
+                    pass
+        except KeyboardInterrupt:
+            pass
+    finally:
+        sock.close()
+        os.unlink(path)
+    return 0
+
+
+def save_profile(profiler, opts):
+    """Write profiling result to stderr and/or JSON file"""
+    if opts.profile:
+        profiler.report(sys.stderr)
+    if opts.profile_json:
+        import json
+        f = open(opts.profile_json, 'w')
+        try:
+            json.dump(profiler.result(), f, indent=2, sort_keys=True)
+        finally:
+            f.close()
 
 
 def decode(line):
-    """Decode UTF-8 if necessary."""
+    """Decode UTF-8, or FALLBACK_ENCODING if line is not valid UTF-8, with
+    undecodable bytes replaced"""
     try:
         return line.decode('utf-8')
-    except AttributeError:
-        return line
+    except UnicodeDecodeError:
+        return line.decode(FALLBACK_ENCODING, 'replace')
 
 
-def main():
-    import optparse
+def _check_encoding(option, opt_str, value, parser):
+    import codecs
+    try:
+        codecs.lookup(value)
+    except LookupError:
+        parser.error('unknown encoding: %s' % value)
+    parser.values.fallback_encoding = value
 
-    supported_vcs = [check[0] for check, _ in REVISION_CONTROL]
+
+def make_parser():
+    import optparse
 
     usage = """
   %prog [options]
@@ -575,50 +3670,212 @@ def main():
             help=('show in side-by-side mode'))
     parser.add_option('-w', '--width', type='int', default=80, metavar='N',
             help='set text width (side-by-side mode only), default is 80')
-    opts, args = parser.parse_args()
+    parser.add_option('-j', '--jobs', type='int', default=1, metavar='N',
+            help='render files in N parallel processes, default is 1')
+    parser.add_option('--diff-engine', type='choice', metavar='NAME',
+            choices=sorted(DIFF_ENGINES.keys()), default=DEFAULT_DIFF_ENGINE,
+            help=('intraline diff engine, one of %s, default is %s' %
+                  (', '.join(sorted(DIFF_ENGINES.keys())),
+                   DEFAULT_DIFF_ENGINE)))
+    parser.add_option('--max-hunk-lines', type='int', metavar='N',
+            default=MAX_HUNK_LINES,
+            help=('intraline diff of hunks longer than N lines is done in '
+                  'windows of N lines, default is %d' % MAX_HUNK_LINES))
+    parser.add_option('--max-line-length', type='int', metavar='N',
+            default=MAX_LINE_LENGTH,
+            help=('no intraline diff for hunks with lines longer than N, '
+                  'default is %d' % MAX_LINE_LENGTH))
+    parser.add_option('--max-intraline-work', type='int', metavar='N',
+            default=MAX_INTRALINE_WORK,
+            help=('no intraline diff for hunks with more than N chars '
+                  'changed, default is %d' % MAX_INTRALINE_WORK))
+    parser.add_option('--fallback-encoding', metavar='NAME',
+            default=FALLBACK_ENCODING, action='callback', type='string',
+            callback=_check_encoding,
+            help=('decode lines not valid in UTF-8 in this encoding, '
+                  'default is %s' % FALLBACK_ENCODING))
+    parser.add_option('--include', action='append', metavar='GLOB',
+            help=('only show files with path matching GLOB, can be '
+                  'repeated'))
+    parser.add_option('--exclude', action='append', metavar='GLOB',
+            help=('skip files with path matching GLOB, can be repeated, '
+                  'wins over --include'))
+    parser.add_option('--stat', action='store_true',
+            help=('only show number of lines added and removed per file, '
+                  'fast on huge input'))
+    parser.add_option('--pager', default=PAGER, metavar='CMD',
+            help='page output with CMD, default is "%s"' % PAGER)
+    parser.add_option('--cache', action='store_true',
+            help=('reuse output rendered before for the same input, saved '
+                  'in %s' % default_cache_dir()))
+    parser.add_option('--cache-dir', metavar='DIR',
+            help='save rendered output in DIR, implies --cache')
+    parser.add_option('--cache-size', type='int', default=CACHE_SIZE,
+            metavar='MB', help=('max size of cache dir in MB, default is %d' %
+                                CACHE_SIZE))
+    parser.add_option('--server', action='store_true',
+            help=('keep running and render for other cdiff invocations, '
+                  'which use it when it is up'))
+    parser.add_option('--profile', action='store_true',
+            help='print time spent in each stage to stderr')
+    parser.add_option('--profile-json', metavar='FILE',
+            help='save time spent in each stage to FILE as JSON')
+    return parser
 
+
+def main():
+    global PROFILER, MAX_HUNK_LINES, MAX_LINE_LENGTH, MAX_INTRALINE_WORK, \
+        FALLBACK_ENCODING
+
+    args = sys.argv[1:]
+    if not CLIENT and sys.stdout.isatty() and '--server' not in args:
+        status = run_client()
+        if status is not None:
+            return status
+
+    opts = None
+    # Piped output without options is only passed through, optparse costs
+    # more to load than the rest of startup so it's skipped then
+    if sys.stdout.isatty() or [arg for arg in args if arg.startswith('-')]:
+        opts, args = make_parser().parse_args(args)
+        if opts.server:
+            return serve(server_socket_path())
+
+        MAX_HUNK_LINES = opts.max_hunk_lines
+        MAX_LINE_LENGTH = opts.max_line_length
+        MAX_INTRALINE_WORK = opts.max_intraline_work
+        FALLBACK_ENCODING = opts.fallback_encoding
+
+        if opts.profile or opts.profile_json:
+            PROFILER = Profiler()
+
+    # Binary stdin, the diff is parsed as bytes
+    stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+    diff_proc = None
     if len(args) > 2:
-        parser.print_help()
+        make_parser().print_help()
         return 1
     elif len(args) == 2:
-        diff_hdl = subprocess.Popen(['diff', '-u', args[0], args[1]],
-                stdout=subprocess.PIPE).stdout
+        try:
+            if os.path.isdir(args[0]) and os.path.isdir(args[1]):
+                diff_hdl = DirPair(args[0], args[1], opts and opts.include,
+                                   opts and opts.exclude)
+            else:
+                diff_hdl = FilePair(args[0], args[1])
+        except EnvironmentError:
+            e = sys.exc_info()[1]
+            sys.stderr.write('*** %s: %s\n' % (e.filename, e.strerror))
+            return 1
     elif len(args) == 1:
-        if IS_PY3:
-            # Python3 needs the newline='' to keep '\r' (DOS format)
-            diff_hdl = open(args[0], mode='rt', newline='')
-        else:
-            diff_hdl = open(args[0], mode='rt')
+        diff_hdl = None
+        if sys.stdout.isatty():
+            try:
+                diff_hdl = PatchMap(args[0])
+            except (EnvironmentError, ValueError):
+                pass    # Not mappable, e.g. a named pipe
+        if diff_hdl is None:
+            # Passed through or read as a stream
+            diff_hdl = open(args[0], 'rb')
     elif sys.stdin.isatty():
-        diff_hdl = revision_control_diff()
-        if not diff_hdl:
+        diff_proc = revision_control_diff()
+        if not diff_proc:
+            supported_vcs = [check[0] for check, _ in REVISION_CONTROL]
             sys.stderr.write(('*** Not in a supported workspace, supported '
                               'are: %s\n\n') % ', '.join(supported_vcs))
-            parser.print_help()
+            make_parser().print_help()
             return 1
+        diff_hdl = diff_proc.stdout
     else:
-        diff_hdl = sys.stdin
+        diff_hdl = stdin
 
-    # FIXME: can't use generator for now due to current implementation in parser
-    stream = [decode(line) for line in diff_hdl.readlines()]
-
-    if diff_hdl is not sys.stdin:
-        diff_hdl.close()
-
-    # Don't let empty diff pass thru
-    if not stream:
-        return 0
+    reader = None
+    try:
+        if opts and opts.stat:
+            try:
+                stat_to_pager(diff_hdl, opts)
+            except KeyboardInterrupt:
+                pass
+            return 0
+
+        if not sys.stdout.isatty() and opts and (opts.include or
+                opts.exclude) and not isinstance(diff_hdl, DirPair):
+            # Pipe out lines of wanted files untouched
+            items = filter_patch(izip(diff_hdl, itertools.repeat(None),
+                                      itertools.repeat(None)),
+                                 path_matcher(opts.include, opts.exclude))
+            out = getattr(sys.stdout, 'buffer', sys.stdout)
+            out.writelines(item[0] for item in items)
+            return 0
+
+        if not sys.stdout.isatty() and isinstance(diff_hdl,
+                                                  (FilePair, DirPair)):
+            # Write out the patch `diff -u` or `diff -ru` would give
+            out = getattr(sys.stdout, 'buffer', sys.stdout)
+            out.writelines(diff_hdl)
+            return 0
+
+        if not sys.stdout.isatty():
+            # Pipe out diff untouched to make sure it is still a patch, an
+            # empty diff gives empty output
+            copy = copy_stream
+            if PROFILER:
+                copy = PROFILER.call('copy', copy)
+            copy(diff_hdl, getattr(sys.stdout, 'buffer', sys.stdout))
+            return 0
+
+        if isinstance(diff_hdl, (PatchMap, FilePair, DirPair)):
+            # Lines are read from the map as the parser goes, or hunks of the
+            # files compared are made directly
+            stream = diff_hdl
+        else:
+            if diff_proc or diff_hdl is stdin:
+                # Overlap the producer of diff with parsing and rendering
+                reader = PipeReader(diff_hdl)
+                stream = iter(reader)
+            else:
+                stream = iter(diff_hdl)
+            if PROFILER:
+                stream = PROFILER.iterate('read', iter, stream)
+
+        # Don't let empty diff pass thru
+        if isinstance(stream, PatchMap):
+            if not len(stream):
+                return 0
+        elif isinstance(stream, FilePair):
+            if stream.is_identical():
+                return 0
+            if stream.is_binary():
+                out = getattr(sys.stdout, 'buffer', sys.stdout)
+                out.writelines(stream)
+                out.flush()
+                return 0
+        elif isinstance(stream, DirPair):
+            # Files are compared as output goes, nothing is known ahead
+            pass
+        else:
+            head = list(itertools.islice(stream, 1))
+            if not head:
+                return 0
+            stream = itertools.chain(head, stream)
 
-    if sys.stdout.isatty():
         try:
-            markup_to_pager(stream, opts)
-        except IOError:
-            e = sys.exc_info()[1]
-            if e.errno == errno.EPIPE:
-                pass
-    else:
-        # pipe out stream untouched to make sure it is still a patch
-        sys.stdout.write(''.join(stream))
+            if opts.cache or opts.cache_dir:
+                cache = RenderCache(opts.cache_dir or default_cache_dir(),
+                                    opts.cache_size * 1024 * 1024)
+                cached_markup_to_pager(stream, opts, cache)
+            else:
+                markup_to_pager(stream, opts)
+        except KeyboardInterrupt:
+            pass
+    finally:
+        if reader:
+            reader.close()
+        if diff_proc:
+            terminate(diff_proc)
+        if diff_hdl is not stdin:
+            diff_hdl.close()
+        if PROFILER:
+            save_profile(PROFILER, opts)
 
     return 0
 
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark for the parse and markup paths of cdiff on synthetic unified diffs.
+
+Each stage (parse, mdiff, markup_traditional, markup_side_by_side, write) is
+timed separately and reported in lines/s, MB/s and peak memory.  Results can be
+saved as JSON and compared against a saved baseline, exit status is 1 if any
+stage is slower or takes more memory than the baseline by more than the
+threshold.  A run of a stage repeats it for at least MIN_RUN_SECONDS, so short
+stages are not timed by a single pass.  A reference workload of difflib, which
+changes of cdiff can't speed up or slow down, is timed along with the stages,
+baseline times are scaled by its speed so a machine that is busier or slower
+than when the baseline was saved doesn't show as a regression.
+"""
+
+import sys
+import os
+import time
+import random
+import json
+import difflib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import cdiff
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+# Each timed run repeats a stage until it took this long
+MIN_RUN_SECONDS = 0.2
+
+# Slow down and memory growth below these are noise, not regressions
+MIN_SLOWDOWN_SECONDS = 0.002
+MIN_GROWTH_KB = 256
+
+
+WORDS = ('self', 'return', 'if', 'else', 'for', 'in', 'line', 'markup',
+         'width', 'hunk', 'diff', '=', '+', '(', ')', ':', 'None', '0', '1')
+NON_ASCII_WORDS = (u'中文', u'注释', u'caf\xe9', u'na\xefve',
+                   u'\xfcber')
+
+
+def _random_line(rnd, length, non_ascii):
+    words = []
+    size = 0
+    while size < length:
+        if non_ascii and rnd.random() < 0.1:
+            word = rnd.choice(NON_ASCII_WORDS)
+        else:
+            word = rnd.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return (u'    ' + u' '.join(words))[:length]
+
+
+def _mutate(rnd, line):
+    """Change a few chars so the pair gets intraline highlighting"""
+    chars = list(line)
+    for _ in range(max(1, len(chars) // 20)):
+        pos = rnd.randrange(len(chars) or 1)
+        chars[pos:pos + 1] = [rnd.choice('xyzXYZ_')]
+    return u''.join(chars)
+
+
+def generate(files=50, hunks=4, lines=40, length=80, density=0.3,
+             crlf=False, non_ascii=False, seed=0):
+    """Returns a synthetic unified diff as a list of lines.  density is the
+    fraction of hunk lines that are changed, the rest are context"""
+    rnd = random.Random(seed)
+    eol = crlf and u'\r\n' or u'\n'
+    out = []
+    for num in range(files):
+        path = u'src/module%d/file%d.py' % (num % 7, num)
+        out.append(u'diff --git a/%s b/%s%s' % (path, path, eol))
+        out.append(u'index 1234567..89abcde 100644' + eol)
+        out.append(u'--- a/%s%s' % (path, eol))
+        out.append(u'+++ b/%s%s' % (path, eol))
+        start = 1
+        for _ in range(hunks):
+            body = []
+            old_len = new_len = 0
+            while old_len + new_len < lines * 2:
+                line = _random_line(rnd, length, non_ascii)
+                r = rnd.random()
+                if r < density * 0.6:
+                    body.append(u'-' + line + eol)
+                    body.append(u'+' + _mutate(rnd, line) + eol)
+                    old_len += 1
+                    new_len += 1
+                elif r < density * 0.8:
+                    body.append(u'-' + line + eol)
+                    old_len += 1
+                elif r < density:
+                    body.append(u'+' + line + eol)
+                    new_len += 1
+                else:
+                    body.append(u' ' + line + eol)
+                    old_len += 1
+                    new_len += 1
+            out.append(u'@@ -%d,%d +%d,%d @@%s' %
+                       (start, old_len, start, new_len, eol))
+            out.extend(body)
+            start += old_len + 10
+    return out
+
+
+def _parse(lines):
+    return list(cdiff.DiffParser(lines).get_diffs())
+
+
+def stage_parse(lines, diffs, rendered, opts):
+    _parse(lines)
+
+
+def stage_mdiff(lines, diffs, rendered, opts):
+    for diff in diffs:
+        for hunk in diff._hunks:
+            for _ in hunk.mdiff(opts.diff_engine):
+                pass
+
+
+def stage_markup_traditional(lines, diffs, rendered, opts):
+    for diff in diffs:
+        for _ in diff.markup_traditional(opts.diff_engine):
+            pass
+
+
+def stage_markup_side_by_side(lines, diffs, rendered, opts):
+    for diff in diffs:
+        for _ in diff.markup_side_by_side(opts.width, opts.diff_engine):
+            pass
+
+
+def stage_write(lines, diffs, rendered, opts):
+    out = open(os.devnull, 'wb')
+    try:
+        cdiff.write_lines(rendered, out)
+    finally:
+        out.close()
+
+
+STAGES = (
+    ('parse', stage_parse),
+    ('mdiff', stage_mdiff),
+    ('markup_traditional', stage_markup_traditional),
+    ('markup_side_by_side', stage_markup_side_by_side),
+    ('write', stage_write),
+)
+
+
+def stage_reference(lines, diffs, rendered, opts):
+    """Not of cdiff, measures the speed of the machine"""
+    for i in range(0, min(len(lines), 2000) - 1, 2):
+        difflib.SequenceMatcher(None, lines[i], lines[i + 1]).get_opcodes()
+
+
+def _time_passes(stage, passes, args):
+    start = time.time()
+    for _ in range(passes):
+        cdiff.INTRALINE_CACHE.clear()
+        stage(*args)
+    return time.time() - start
+
+
+def run(lines, opts, names=None):
+    """Returns dict of stage name -> result dict for stages in names or
+    opts.stages (default all), seconds of a stage is of one pass, best of
+    opts.repeat runs of many passes.  Runs of the stages
+    are interleaved, so a slow spell of the machine doesn't take all runs of
+    one stage"""
+    # cdiff reads input as bytes
+    lines = [line.encode('utf-8') for line in lines]
+    num_lines = len(lines)
+    num_bytes = sum([len(line) for line in lines])
+    diffs = _parse(lines)
+    rendered = []
+    for diff in diffs:
+        rendered.extend(diff.markup_traditional(opts.diff_engine))
+    args = (lines, diffs, rendered, opts)
+
+    names = names or opts.stages
+    stages = [(name, stage) for name, stage in STAGES
+              if not names or name in names]
+    stages.append(('reference', stage_reference))
+    passes = {}
+    best = {}
+    for name, stage in stages:
+        count = 1
+        elapsed = _time_passes(stage, count, args)
+        while elapsed < MIN_RUN_SECONDS:
+            count = max(count * 2,
+                        int(count * MIN_RUN_SECONDS / max(elapsed, 1e-6)))
+            elapsed = _time_passes(stage, count, args)
+        passes[name] = count
+        best[name] = elapsed / count
+    for _ in range(opts.repeat - 1):
+        for name, stage in stages:
+            best[name] = min(best[name],
+                             _time_passes(stage, passes[name], args) /
+                             passes[name])
+
+    results = {'reference': {'seconds': best['reference']}}
+    for name, stage in stages[:-1]:
+        peak = None
+        if tracemalloc:
+            cdiff.INTRALINE_CACHE.clear()
+            tracemalloc.start()
+            stage(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        seconds = max(best[name], 1e-9)
+        results[name] = {
+            'seconds': seconds,
+            'lines_per_sec': num_lines / seconds,
+            'mb_per_sec': num_bytes / seconds / 1024.0 / 1024.0,
+            'peak_kb': peak is not None and peak // 1024 or None,
+        }
+    return results
+
+
+def compare(results, baseline, threshold, memory_threshold):
+    """Returns list of (stage name, message) of regressions in time and in
+    peak memory.  Baseline times are scaled by the speed of the reference
+    workload"""
+    regressions = []
+    speed = 1.0
+    reference = baseline.get('results', {}).get('reference')
+    if reference:
+        speed = results['reference']['seconds'] / reference['seconds']
+    for name, result in sorted(results.items()):
+        base = baseline.get('results', {}).get(name)
+        if not base or name == 'reference':
+            continue
+        base_seconds = base['seconds'] * speed
+        slowdown = result['seconds'] - base_seconds
+        if slowdown > max(base_seconds * threshold, MIN_SLOWDOWN_SECONDS):
+            regressions.append((name, '%s: %.4fs vs baseline %.4fs scaled '
+                                'by machine speed %.2f (%+.0f%%)' %
+                                (name, result['seconds'], base['seconds'],
+                                 speed, slowdown / base_seconds * 100)))
+        if result['peak_kb'] is None or base.get('peak_kb') is None:
+            continue
+        growth = result['peak_kb'] - base['peak_kb']
+        if growth > max(base['peak_kb'] * memory_threshold, MIN_GROWTH_KB):
+            regressions.append((name, '%s: peak %d KB vs baseline %d KB '
+                                '(%+.0f%%)' %
+                                (name, result['peak_kb'], base['peak_kb'],
+                                 growth * 100.0 / max(base['peak_kb'], 1))))
+    return regressions
+
+
+def report(results, out):
+    out.write('%-22s %10s %14s %10s %10s\n' %
+              ('stage', 'seconds', 'lines/s', 'MB/s', 'peak KB'))
+    for name, _ in STAGES:
+        if name not in results:
+            continue
+        r = results[name]
+        out.write('%-22s %10.4f %14.0f %10.2f %10s\n' %
+                  (name, r['seconds'], r['lines_per_sec'], r['mb_per_sec'],
+                   r['peak_kb'] is None and '-' or r['peak_kb']))
+    out.write('%-22s %10.4f  (difflib, speed of the machine)\n' %
+              ('reference', results['reference']['seconds']))
+
+
+def main():
+    import optparse
+
+    parser = optparse.OptionParser(usage='%prog [options]',
+            description='Benchmark cdiff parse and markup stages')
+    parser.add_option('--files', type='int', default=50,
+            help='number of files in generated diff, default is 50')
+    parser.add_option('--hunks', type='int', default=4,
+            help='hunks per file, default is 4')
+    parser.add_option('--lines', type='int', default=40,
+            help='lines per hunk, default is 40')
+    parser.add_option('--length', type='int', default=80,
+            help='line length, default is 80')
+    parser.add_option('--density', type='float', default=0.3,
+            help='fraction of changed lines in hunk, default is 0.3')
+    parser.add_option('--crlf', action='store_true',
+            help='use DOS line endings')
+    parser.add_option('--non-ascii', action='store_true',
+            help='mix non-ASCII words into lines')
+    parser.add_option('--seed', type='int', default=0,
+            help='random seed, default is 0')
+    parser.add_option('--diff-engine', default=cdiff.DEFAULT_DIFF_ENGINE,
+            choices=sorted(cdiff.DIFF_ENGINES.keys()), metavar='NAME',
+            help='intraline diff engine, default is %s' %
+                 cdiff.DEFAULT_DIFF_ENGINE)
+    parser.add_option('-w', '--width', type='int', default=80,
+            help='side by side text width, default is 80')
+    parser.add_option('--stage', action='append', dest='stages',
+            metavar='NAME', choices=[name for name, _ in STAGES],
+            help='only run given stage, can be repeated')
+    parser.add_option('--repeat', type='int', default=5,
+            help='report best of N runs, default is 5')
+    parser.add_option('--save', metavar='FILE',
+            help='save results as JSON to FILE')
+    parser.add_option('--baseline', metavar='FILE',
+            help='compare with results saved in FILE')
+    parser.add_option('--threshold', type='float', default=0.2,
+            help='allowed slow down against baseline, default is 0.2')
+    parser.add_option('--memory-threshold', type='float', default=0.2,
+            help='allowed peak memory growth against baseline, default is '
+                 '0.2')
+    opts, args = parser.parse_args()
+
+    shape = {
+        'files': opts.files,
+        'hunks': opts.hunks,
+        'lines': opts.lines,
+        'length': opts.length,
+        'density': opts.density,
+        'crlf': bool(opts.crlf),
+        'non_ascii': bool(opts.non_ascii),
+        'seed': opts.seed,
+    }
+    lines = generate(**shape)
+    results = run(lines, opts)
+    report(results, sys.stdout)
+
+    if opts.save:
+        data = {
+            'version': cdiff.META_INFO['version'],
+            'python': sys.version.split()[0],
+            'shape': shape,
+            'diff_engine': opts.diff_engine,
+            'results': results,
+        }
+        f = open(opts.save, 'w')
+        try:
+            json.dump(data, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+    if opts.baseline:
+        if not os.path.exists(opts.baseline):
+            sys.stderr.write('*** No baseline %s, skip comparing\n' %
+                             opts.baseline)
+            return 0
+        f = open(opts.baseline)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        if baseline.get('shape') != shape:
+            sys.stderr.write('*** Baseline is for a different diff shape\n')
+            return 1
+        if baseline.get('diff_engine') != opts.diff_engine:
+            sys.stderr.write('*** Baseline is for diff engine %s\n' %
+                             baseline.get('diff_engine'))
+            return 1
+        regressions = compare(results, baseline, opts.threshold,
+                              opts.memory_threshold)
+        if regressions:
+            # Confirmed by another run of the stages, a slow spell of the
+            # machine is over by then
+            names = sorted(set([name for name, _ in regressions]))
+            sys.stderr.write('Running %s again to confirm\n' %
+                             ', '.join(names))
+            again = run(lines, opts, names)
+            for name in names + ['reference']:
+                results[name]['seconds'] = min(results[name]['seconds'],
+                                               again[name]['seconds'])
+            regressions = compare(results, baseline, opts.threshold,
+                                  opts.memory_threshold)
+        if regressions:
+            sys.stderr.write('*** Regressions over %.0f%% in time or %.0f%% '
+                             'in memory:\n' % (opts.threshold * 100,
+                                              opts.memory_threshold * 100))
+            for _, msg in regressions:
+                sys.stderr.write('    %s\n' % msg)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim:set et sts=4 sw=4 tw=80:
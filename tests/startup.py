@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Startup benchmark for cdiff, based on `python -X importtime` (python >= 3.7).
+
+Time to import cdiff is measured with bytecode cached, as for an installed
+module, and modules loaded on the passthrough path (output piped) are checked
+against a list that must not be imported there.  Exit status is 1 if import
+time is over the budget or any of the modules is loaded.
+"""
+
+import sys
+import os
+import shutil
+import subprocess
+import tempfile
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CDIFF = os.path.join(TOP_DIR, 'cdiff.py')
+PATCH = os.path.join(TOP_DIR, 'tests', 'git.diff')
+
+# Modules cdiff must not load just to pass a diff through
+PASSTHROUGH_FORBIDDEN = ('re', 'subprocess', 'difflib', 'optparse',
+                         'threading', 'collections', 'array', 'unicodedata')
+
+
+def _importtime(args, env, stdin=None):
+    """Runs python -X importtime with args, returns list of (module,
+    cumulative microseconds)"""
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime'] + args,
+                            stdin=stdin, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, env=env, cwd=TOP_DIR)
+    _, err = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError('%s failed:\n%s' % (args, err.decode()))
+    result = []
+    for line in err.decode().splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            continue    # the header line
+        result.append((fields[2].strip(), cumulative))
+    return result
+
+
+def import_time(env, repeat):
+    """Best cumulative microseconds of importing cdiff"""
+    best = None
+    for _ in range(repeat + 1):     # first run writes bytecode cache
+        for name, cumulative in _importtime(['-c', 'import cdiff'], env):
+            if name == 'cdiff' and (best is None or cumulative < best):
+                best = cumulative
+    return best
+
+
+def passthrough_modules(env):
+    """Modules loaded by cdiff piping a patch through, beyond those of a bare
+    interpreter"""
+    bare = set(name for name, _ in _importtime(['-c', 'pass'], env))
+    f = open(PATCH, 'rb')
+    try:
+        loaded = _importtime([CDIFF], env, stdin=f)
+    finally:
+        f.close()
+    return [name for name, _ in loaded if name not in bare]
+
+
+def main():
+    import optparse
+
+    parser = optparse.OptionParser(usage='%prog [options]',
+            description='Benchmark cdiff startup')
+    parser.add_option('--budget', type='float', default=5.0, metavar='MS',
+            help='max time to import cdiff in ms, default is 5')
+    parser.add_option('--repeat', type='int', default=5,
+            help='report best of N runs, default is 5')
+    opts, args = parser.parse_args()
+
+    if sys.hexversion < 0x03070000:
+        sys.stderr.write('*** Requires python >= 3.7 for -X importtime\n')
+        return 1
+
+    cache_dir = tempfile.mkdtemp(prefix='cdiff-startup-')
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPYCACHEPREFIX'] = cache_dir
+    try:
+        elapsed = import_time(env, opts.repeat) / 1000.0
+        modules = passthrough_modules(env)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    sys.stdout.write('import cdiff: %.2f ms (budget %.2f ms)\n' %
+                     (elapsed, opts.budget))
+    sys.stdout.write('passthrough loads: %s\n' % (', '.join(modules) or '-'))
+
+    failed = False
+    if elapsed > opts.budget:
+        sys.stderr.write('*** Import time over budget\n')
+        failed = True
+    forbidden = [name for name in modules if name in PASSTHROUGH_FORBIDDEN]
+    if forbidden:
+        sys.stderr.write('*** Passthrough loads %s\n' % ', '.join(forbidden))
+        failed = True
+    return failed and 1 or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim:set et sts=4 sw=4 tw=80: